@@ -2,7 +2,7 @@
 
 __author__ = "Sunshine'Z"
 
-import json, logging, inspect, functools
+import json, base64, logging, inspect, functools
 
 class Page(object):
 	'''
@@ -15,12 +15,24 @@ class Page(object):
 	:page_index:当前页
 	:has_next:是否有一下一页
 	:has_previous:是否有上一页
+	:cursor:keyset分页的游标，存在时不再使用offset，从游标位置之后开始取limit条
+	:next_cursor:下一页的游标，由查询结果设置
 	'''
-	def __init__(self, item_count, page_index = 1, page_size = 10):
+	def __init__(self, item_count, page_index = 1, page_size = 10, cursor = None):
 		self.item_count = item_count
 		self.page_size = page_size
 		self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
-		if (item_count == 0) or (page_index > self.page_count):
+		self.cursor = cursor
+		self.next_cursor = None
+		if item_count == 0:
+			self.offset = 0
+			self.limit = 0
+			self.page_index = 1
+		elif cursor:
+			self.page_index = page_index
+			self.offset = 0
+			self.limit = self.page_size
+		elif page_index > self.page_count:
 			self.offset = 0
 			self.limit = 0
 			self.page_index = 1
@@ -31,11 +43,49 @@ class Page(object):
 		self.has_next = self.page_index < self.page_count
 		self.has_previous = self.page_index > 1
 
+	def set_next_cursor(self, items, field = 'created_at'):
+		'''
+		根据本页最后一条记录设置下一页的游标
+		:items:本页记录
+		:field:排序字段
+		:return:无
+		'''
+		if items and len(items) >= self.limit:
+			last = items[-1]
+			self.next_cursor = encode_cursor(getattr(last, field), last.id)
+		else:
+			self.next_cursor = None
+		if self.cursor:
+			self.has_next = self.next_cursor is not None
+
 	def __str__(self):
 		return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
 
 	__repr__ = __str__
 
+def encode_cursor(value, pk):
+	'''
+	生成keyset分页的游标: JSON数组[排序字段的值, 主键值]的URL安全base64，保留排序字段值的类型(数字或者字符串)
+	:value:排序字段的值
+	:pk:主键值
+	:return:游标字符串
+	'''
+	return base64.urlsafe_b64encode(json.dumps([value, pk]).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+	'''
+	解析keyset分页的游标
+	:cursor:游标字符串
+	:return:(排序字段的值, 主键值)
+	'''
+	try:
+		value, pk = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+	except (ValueError, TypeError):
+		raise APIValueError('cursor', 'Invalid cursor.')
+	if isinstance(value, bool) or not isinstance(value, (int, float, str)) or not isinstance(pk, str):
+		raise APIValueError('cursor', 'Invalid cursor.')
+	return value, pk
+
 class APIError(Exception):
 	'''
 	基础的APIError，包含错误类型(必要)，数据(可选)，信息(可选)
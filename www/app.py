@@ -3,29 +3,45 @@
 __author__ = "Sunshine'Z"
 
 
-import logging; logging.basicConfig(level = logging.DEBUG)
+import logging
 
-import asyncio, os, json, time
+import asyncio, os, time, hashlib
 from datetime import datetime
 
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
 from config import configs
 
-import orm
-from coroweb import add_routes, add_static
+import logs; logs.init_logging(**configs.logging)
+from cache import response_cache, response_generation
+
+import orm, serializer, timing, markdowns
+from templating import Renderer
+from coroweb import add_routes, add_static, get_route_access, ACCESS_STATIC, ACCESS_AUTHENTICATED
 
 from handlers import cookie2user, COOKIE_NAME
 
+logger = logging.getLogger('app')
+# 每个请求都会输出的日志
+_request_logger = logging.getLogger('app.request')
+# 慢请求日志
+_slow_logger = logging.getLogger('app.slow')
+
 def init_jinja2(app, **kw):
 	'''
 	初始化jinja2模板
 	:app:Application is a synonym for web-server.
 	:kw:配置参数
+		production - 生产模式，关闭auto_reload，使用字节码缓存，并在启动时编译全部模板
+		bytecode_cache - 字节码缓存目录，None使用系统临时目录
+		render - 渲染方式: sync、async或者thread，见templating
+		render_workers - thread方式的线程数
 	:return:空
 	'''
-	logging.info('init jinja2...')
+	logger.info('init jinja2...')
+	production = kw.get('production', False)
+	render = kw.get('render', 'sync')
 	options = dict(
 		# If set to true the XML/HTML autoescaping feature is enabled by default. 
 		autoescape = kw.get('autoescape', True),
@@ -41,12 +57,20 @@ def init_jinja2(app, **kw):
 		# change (ie: file system or database). If auto_reload is set to True (default) 
 		# every time a template is requested the loader checks if the source changed and if yes, 
 		# it will reload the template. For higher performance it’s possible to disable that.
-		auto_reload = kw.get('auto_reload', True)
+		auto_reload = kw.get('auto_reload', not production),
+		# 编译为异步模板，使用render_async渲染
+		enable_async = render == 'async'
 	)
+	if production:
+		# 编译结果按模板源码的校验和缓存在文件中，重启后不需要重新编译
+		directory = kw.get('bytecode_cache')
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		options['bytecode_cache'] = FileSystemBytecodeCache(directory)
 	path = kw.get('path', None)
 	if path is None:
 		path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
-	logging.info('set jinja2 template path: %s' % path)
+	logger.info('set jinja2 template path: %s', path)
 	'''
 	FileSystemLoader
 	Loads templates from the file system. 
@@ -61,7 +85,54 @@ def init_jinja2(app, **kw):
 	if filters is not None:
 		for name, f in filters.items():
 			env.filters[name] = f
+	if production:
+		precompile_templates(env)
 	app['__templating__'] = env
+	app['__renderer__'] = Renderer(env, render, kw.get('render_workers', 4))
+
+def precompile_templates(env):
+	'''
+	编译模板目录中的全部模板并放入env的缓存，避免部署或重启后第一个请求现场编译
+	模板中的错误在启动时就会抛出
+	:env:jinja2 Environment，过滤器必须已经注册
+	:return:编译的模板数
+	'''
+	start = time.time()
+	names = env.list_templates()
+	for name in names:
+		env.get_template(name)
+	logger.info('precompiled %s templates in %.1fms', len(names), (time.time() - start) * 1000)
+	return len(names)
+
+async def timing_factory(app, handler):
+	'''
+	timing_factory middleware
+	统计请求的总耗时以及auth、handler、db、render各阶段的耗时，输出Server-Timing响应头，
+	超过configs.timing.slow_ms的请求连同执行的语句写入慢请求日志
+	:app:Application is a synonym for web-server.
+	:handler:RequestHandler object
+	:return:fn
+	'''
+	slow = configs.timing.slow_ms / 1000
+	header = configs.timing.header
+	async def timer(request):
+		if get_route_access(request) == ACCESS_STATIC:
+			return await handler(request)
+		t, token = timing.start()
+		try:
+			r = await handler(request)
+		finally:
+			timing.stop(token)
+			total = t.elapsed()
+			if total >= slow and _slow_logger.isEnabledFor(logging.WARNING):
+				_slow_logger.warning('Slow request: %s %s %.1fms (%s), %s queries: %s', request.method, request.path_qs,
+					total * 1000, t.server_timing(total), t.query_count,
+					'; '.join('%.1fms %s' % (s * 1000, sql) for sql, s in t.queries))
+		# 流式响应在handler中已经发送了响应头
+		if header and isinstance(r, web.StreamResponse) and not r.prepared:
+			r.headers['Server-Timing'] = t.server_timing(total)
+		return r
+	return timer
 
 async def logger_factory(app, handler):
 	'''
@@ -71,10 +142,26 @@ async def logger_factory(app, handler):
 	:return:fn
 	'''
 	async def logger(request):
-		logging.info('Request: %s %s' % (request.method, request.path))
+		# 静态资源不记录日志
+		if get_route_access(request) != ACCESS_STATIC:
+			_request_logger.info('Request: %s %s', request.method, request.path)
 		return (await handler(request))
 	return logger
 
+async def identity_factory(app, handler):
+	'''
+	identity_factory middleware
+	每个请求使用自己的identity map，同一个请求中多次Model.find(pk)同一条记录只查询一次数据库；
+	写入之后读主库、不合并查询的范围也限定在本请求内，启动时(create_tables等)的写入不会影响请求
+	:app:Application is a synonym for web-server.
+	:handler:RequestHandler object
+	:return:fn
+	'''
+	async def identity(request):
+		with orm.identity_scope():
+			return await handler(request)
+	return identity
+
 async def auth_factory(app, handler):
 	'''
 	auth_factory middleware
@@ -83,13 +170,17 @@ async def auth_factory(app, handler):
 	:return:fn
 	'''
 	async def auth(request):
-		logging.info('check user: %s %s' % (request.method, request.path))
 		request.__user__ = None
+		# 静态资源和匿名路由不需要解析cookie
+		if get_route_access(request) != ACCESS_AUTHENTICATED:
+			return await handler(request)
+		_request_logger.info('check user: %s %s', request.method, request.path)
 		cookie_str = request.cookies.get(COOKIE_NAME)
 		if cookie_str:
-			user = await cookie2user(cookie_str)
+			with timing.phase('auth'):
+				user = await cookie2user(cookie_str)
 			if user:
-				logging.info('set current user: %s' % user.email)
+				_request_logger.info('set current user: %s', user.email)
 				request.__user__ = user
 		if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
 			return web.HTTPFound('/signin')
@@ -107,10 +198,10 @@ async def data_factory(app, handler):
 		if request.method == 'POST':
 			if request.content_type.startswith('application/json'):
 				request.__data__ = await request.json()
-				logging.info('request json: %s' % str(request.__data__))
+				_request_logger.debug('request json: %s', request.__data__)
 			elif request.content_type.startswith('application/x-www-form-urlencoded'):
 				request.__data__ = await request.post()
-				logging.info('request form: %s' % str(request.__data__))
+				_request_logger.debug('request form: %s', request.__data__)
 		return (await handler(request))
 	return parse_data
 
@@ -122,11 +213,26 @@ async def response_factory(app, handler):
 	:return:fn
 	'''
 	async def response(request):
-		logging.info('Response handler...')
-		r = await handler(request)
+		_request_logger.debug('Response handler...')
+		# 声明了cache的GET路由，按 路由+查询参数+当前用户 缓存渲染结果
+		cache_key = None
+		ttl = getattr(request.match_info.handler, '__cache__', None)
+		if ttl and request.method == 'GET':
+			user = request.__user__
+			cache_key = (request.path, request.query_string, user.id if user else '')
+			cached = response_cache.get(cache_key)
+			if cached is not None:
+				return cached_response(request, *cached)
+			generation = response_generation()
+		with timing.phase('handler'):
+			r = await handler(request)
 		#StreamResponse - The base class for the HTTP response handling.
 		if isinstance(r, web.StreamResponse):
 			return r
+		# 异步迭代器，例如Model.findAll(stream=True)的结果，以chunked JSON数组的形式输出
+		if hasattr(r, '__aiter__'):
+			with timing.phase('render'):
+				return await stream_response(request, r)
 		if isinstance(r, bytes):
 			'''
 			class aiohttp.web.Response(*, body=None, status=200, reason=None, text=None, \
@@ -146,24 +252,24 @@ async def response_factory(app, handler):
 			return resp
 		if isinstance(r, dict):
 			template = r.get('__template__')
-			if template is None:
-				'''
-				dumps - Serialize obj to a JSON formatted str using this conversion table. 
-				If ensure_ascii is false, the result may contain non-ASCII characters and 
-				the return value may be a unicode instance.
-
-				If specified, default should be a function that gets called for objects that 
-				can’t otherwise be serialized. It should return a JSON encodable version of
-				the object or raise a TypeError. If not specified, TypeError is raised.
-				'''
-				resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
-				resp.content_type = 'application/json;charset=utf-8'
-				return resp
-			else:
-				r['__user__'] = request.__user__
-				resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
-				resp.content_type = 'text/html;charset=utf-8'
-				return resp
+			with timing.phase('render'):
+				if template is None:
+					# serializer.dumps - 序列化为UTF-8编码的JSON，Model按dict处理，Page等类型使用注册的转换函数
+					body = serializer.dumps(r)
+					content_type = 'application/json;charset=utf-8'
+				else:
+					r['__user__'] = request.__user__
+					body = (await app['__renderer__'].render(template, r)).encode('utf-8')
+					content_type = 'text/html;charset=utf-8'
+			# APIError转换得到的错误结果不缓存；处理期间缓存被清空过(博客发生了变化)时，结果可能已经过时，也不缓存
+			if cache_key is not None and not r.get('error'):
+				etag = '"%s"' % hashlib.sha1(body).hexdigest()
+				if response_generation() == generation:
+					response_cache.set(cache_key, (body, content_type, etag), ttl=None if ttl is True else ttl)
+				return cached_response(request, body, content_type, etag)
+			resp = web.Response(body=body)
+			resp.content_type = content_type
+			return resp
 		if isinstance(r, int) and r >= 100 and r < 600:
 			return web.Response(r)
 		if isinstance(r, tuple) and len(r) == 2:
@@ -176,6 +282,61 @@ async def response_factory(app, handler):
 		return resp
 	return response
 
+# 流式响应每次写出的最小字节数
+_STREAM_CHUNK_SIZE = 16384
+
+async def stream_response(request, items):
+	'''
+	将异步迭代器产生的对象逐个序列化，以chunked编码输出JSON数组，内存中只保留一个chunk
+	:request:The Request object contains all the information about an incoming HTTP request.
+	:items:异步迭代器
+	:return:web response
+	'''
+	resp = web.StreamResponse()
+	resp.content_type = 'application/json'
+	resp.charset = 'utf-8'
+	resp.enable_chunked_encoding()
+	await resp.prepare(request)
+	buf = [b'[']
+	size = 1
+	sep = b''
+	try:
+		async for item in items:
+			data = serializer.dumps(item)
+			buf.append(sep)
+			buf.append(data)
+			sep = b','
+			size += len(data) + 1
+			if size >= _STREAM_CHUNK_SIZE:
+				await resp.write(b''.join(buf))
+				buf = []
+				size = 0
+	finally:
+		# 客户端断开等异常情况下也要立即关闭生成器，归还数据库连接
+		aclose = getattr(items, 'aclose', None)
+		if aclose is not None:
+			await aclose()
+	buf.append(b']')
+	await resp.write(b''.join(buf))
+	await resp.write_eof()
+	return resp
+
+def cached_response(request, body, content_type, etag):
+	'''
+	生成带ETag的响应，客户端的If-None-Match匹配时返回304
+	:request:The Request object contains all the information about an incoming HTTP request.
+	:body:响应内容
+	:content_type:响应类型
+	:etag:内容的ETag
+	:return:web response
+	'''
+	if_none_match = request.headers.get('If-None-Match')
+	if if_none_match and etag in [t.strip() for t in if_none_match.split(',')]:
+		return web.Response(status=304, headers={'ETag': etag})
+	resp = web.Response(body=body, headers={'ETag': etag})
+	resp.content_type = content_type
+	return resp
+
 def datetime_filter(t):
 	'''
 	创建模板需要的过滤器
@@ -194,31 +355,57 @@ def datetime_filter(t):
 	dt = datetime.fromtimestamp(t)
 	return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
-async def init(loop):
+async def init_app(loop):
 	'''
-	web框架初始化
+	创建web应用: 数据库连接池、中间件、模板和路由
 	:loop:event loops
-	:return:srv
+	:return:app
 	'''
 	# 初始化mysql连接池
 	# await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='root', password='123456', db='awesome')
 	await orm.create_pool(loop=loop, **configs.db)
+	if configs.db.backend == 'sqlite':
+		# sqlite通常是新建的(内存)数据库，先建表
+		await orm.create_tables()
+	serializer.set_backend(configs.json.backend)
 	'''
 	初始化web框架
 	middlewares - A middleware is a coroutine that can modify either the request or response.
 	'''
 	app = web.Application(loop=loop, middlewares=[
-		logger_factory, auth_factory, response_factory
+		timing_factory, logger_factory, identity_factory, auth_factory, response_factory
 	])
 	# 初始化模板 
-	init_jinja2(app, filters=dict(datetime=datetime_filter))
+	init_jinja2(app, filters=dict(datetime=datetime_filter), **configs.jinja2)
 	# 将模块handlers中的所有函数注册为URL处理函数
 	add_routes(app, 'handlers')
 	# 添加静态文件夹的路径
 	add_static(app)
+	# app.cleanup()时释放连接池和线程池、进程池
+	app.on_cleanup.append(cleanup)
+	return app
+
+async def cleanup(app):
+	'''
+	关闭web应用使用的资源
+	:app:Application is a synonym for web-server.
+	:return:无
+	'''
+	await orm.close_pool()
+	app['__renderer__'].shutdown()
+	markdowns.shutdown()
+
+async def init(loop):
+	'''
+	web框架初始化，单进程运行时使用，监听configs.server.host:port；
+	多进程由launcher.run_worker直接调用init_app并在继承或者自行绑定的socket上创建服务
+	:loop:event loops
+	:return:srv
+	'''
+	app = await init_app(loop)
 	# 创建web服务器
-	srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9001)
-	logging.info('server started at http://127.0.0.1:9001...')
+	srv = await loop.create_server(app.make_handler(), configs.server.host, configs.server.port)
+	logger.info('server started at http://%s:%s...', configs.server.host, configs.server.port)
 	return srv
 
 if __name__ == '__main__':
@@ -0,0 +1,263 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+orm的存储后端
+orm只通过Backend的方法访问连接池和连接，语句统一使用'?'占位符，由后端的translate转换为驱动的格式。
+mysql - aiomysql连接池(缺省)
+sqlite - 标准库sqlite3，缺省为进程内的内存数据库，不需要数据库服务，用于压测、benchmark和CI；
+	所有语句在事件循环中同步执行，只有一个连接，事务期间其他请求等待；
+	副本是各自独立的数据库(参数path)，没有复制，只用于验证orm的读写路由
+'''
+
+import asyncio, sqlite3, logging
+
+try:
+	import aiomysql
+except ImportError:
+	aiomysql = None
+
+logger = logging.getLogger('orm')
+
+class Backend(object):
+	'''
+	后端接口
+	:name:后端名
+	:streaming:是否支持服务端游标，不支持时select_iter先读取全部结果再分批返回
+	:replicas:是否支持只读副本
+	'''
+	name = None
+	streaming = False
+	replicas = False
+
+	def describe(self, kw):
+		'''
+		:return:连接参数的简短描述，用于日志
+		'''
+		return '%s:%s' % (kw.get('host', 'localhost'), kw.get('port', 3306))
+
+	def translate(self, sql):
+		'''
+		将'?'占位符的语句转换为驱动的格式
+		:param sql:sql语句
+		:return:驱动格式的sql语句
+		'''
+		return sql
+
+	async def create_pool(self, loop, kw):
+		raise NotImplementedError
+
+	async def close_pool(self, pool):
+		raise NotImplementedError
+
+	async def acquire(self, pool):
+		raise NotImplementedError
+
+	async def release(self, pool, conn):
+		raise NotImplementedError
+
+	def pool_stats(self, pool):
+		'''
+		:return:(使用中的连接数, 空闲连接数, 最大连接数)
+		'''
+		raise NotImplementedError
+
+	async def select(self, conn, sql, args, size):
+		'''
+		:return:结果为dict的list
+		'''
+		raise NotImplementedError
+
+	async def iterate(self, conn, sql, args, batch):
+		'''
+		使用服务端游标逐批读取查询结果
+		:return:异步生成器，每次产生一批记录(list)
+		'''
+		raise NotImplementedError
+
+	async def execute(self, conn, sql, args):
+		'''
+		:return:影响的行数
+		'''
+		raise NotImplementedError
+
+	async def begin(self, conn):
+		raise NotImplementedError
+
+	async def commit(self, conn):
+		raise NotImplementedError
+
+	async def rollback(self, conn):
+		raise NotImplementedError
+
+	def column_ddl(self, name, field):
+		return '`%s` %s NOT NULL' % (name, field.column_type)
+
+	def create_table_sql(self, model):
+		'''
+		根据Model的__mappings__生成建表语句
+		:param model:Model类
+		:return:sql语句
+		'''
+		columns = [self.column_ddl(field.name or name, field) for name, field in model.__mappings__.items()]
+		columns.append('PRIMARY KEY (`%s`)' % model.__primary_key__)
+		return 'CREATE TABLE IF NOT EXISTS `%s` (\n\t%s\n)' % (model.__table__, ',\n\t'.join(columns))
+
+class MySQLBackend(Backend):
+	'''
+	aiomysql连接池
+	'''
+	name = 'mysql'
+	streaming = True
+	replicas = True
+
+	def translate(self, sql):
+		return sql.replace('?', '%s')
+
+	async def create_pool(self, loop, kw):
+		if aiomysql is None:
+			raise ImportError('aiomysql is required for the mysql backend')
+		return await aiomysql.create_pool(
+			host = kw.get('host', 'localhost'),
+			port = kw.get('port', 3306),
+			user = kw['user'],
+			password = kw['password'],
+			db = kw['db'],
+			charset = kw.get('charset', 'utf8'),
+			autocommit = kw.get('autocommit', True),
+			maxsize = kw.get('maxsize', 10),
+			minsize  = kw.get('minsize', 1),
+			loop = loop
+		)
+
+	async def close_pool(self, pool):
+		pool.close()
+		await pool.wait_closed()
+
+	async def acquire(self, pool):
+		return await pool.acquire()
+
+	async def release(self, pool, conn):
+		await pool.release(conn)
+
+	def pool_stats(self, pool):
+		return pool.size - pool.freesize, pool.freesize, pool.maxsize
+
+	async def select(self, conn, sql, args, size):
+		# 创建一个结果为字典的游标
+		async with conn.cursor(aiomysql.DictCursor) as cur:
+			await cur.execute(sql, args or ())
+			# 如果指定了数量，就返回指定数量的记录，如果没有就返回所有记录
+			if size:
+				return await cur.fetchmany(size)
+			return await cur.fetchall()
+
+	async def iterate(self, conn, sql, args, batch):
+		async with conn.cursor(aiomysql.SSDictCursor) as cur:
+			await cur.execute(sql, args or ())
+			while True:
+				rs = await cur.fetchmany(batch)
+				if not rs:
+					break
+				yield rs
+
+	async def execute(self, conn, sql, args):
+		async with conn.cursor(aiomysql.DictCursor) as cur:
+			await cur.execute(sql, args)
+			return cur.rowcount
+
+	async def begin(self, conn):
+		await conn.begin()
+
+	async def commit(self, conn):
+		await conn.commit()
+
+	async def rollback(self, conn):
+		await conn.rollback()
+
+	def create_table_sql(self, model):
+		return super().create_table_sql(model) + ' ENGINE=InnoDB DEFAULT CHARSET=utf8'
+
+class _SQLitePool(object):
+	'''
+	只有一个连接的"连接池"，用锁保证同一时间只有一个协程(或者一个事务)使用连接
+	'''
+	maxsize = 1
+
+	def __init__(self, conn):
+		self.conn = conn
+		self.lock = asyncio.Lock()
+
+def _dict_factory(cursor, row):
+	return dict(zip([d[0] for d in cursor.description], row))
+
+class SQLiteBackend(Backend):
+	'''
+	标准库sqlite3，参数path为数据库文件，缺省':memory:'
+	'''
+	name = 'sqlite'
+	replicas = True
+
+	def describe(self, kw):
+		return kw.get('path') or ':memory:'
+
+	async def create_pool(self, loop, kw):
+		path = kw.get('path') or ':memory:'
+		logger.info('open sqlite database: %s', path)
+		# isolation_level=None: 自动提交，事务由begin/commit显式控制
+		conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+		conn.row_factory = _dict_factory
+		return _SQLitePool(conn)
+
+	async def close_pool(self, pool):
+		pool.conn.close()
+
+	async def acquire(self, pool):
+		await pool.lock.acquire()
+		return pool.conn
+
+	async def release(self, pool, conn):
+		pool.lock.release()
+
+	def pool_stats(self, pool):
+		in_use = 1 if pool.lock.locked() else 0
+		return in_use, 1 - in_use, 1
+
+	async def select(self, conn, sql, args, size):
+		cur = conn.execute(sql, args or ())
+		try:
+			return cur.fetchmany(size) if size else cur.fetchall()
+		finally:
+			cur.close()
+
+	async def execute(self, conn, sql, args):
+		cur = conn.execute(sql, args or ())
+		try:
+			return cur.rowcount
+		finally:
+			cur.close()
+
+	async def begin(self, conn):
+		conn.execute('BEGIN')
+
+	async def commit(self, conn):
+		conn.execute('COMMIT')
+
+	async def rollback(self, conn):
+		conn.execute('ROLLBACK')
+
+_backends = {
+	'mysql': MySQLBackend,
+	'sqlite': SQLiteBackend
+}
+
+def get_backend(name):
+	'''
+	:param name:后端名，mysql或者sqlite
+	:return:Backend对象
+	'''
+	try:
+		return _backends[name]()
+	except KeyError:
+		raise ValueError('unknown database backend: %s' % name)
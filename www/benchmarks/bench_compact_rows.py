@@ -0,0 +1,45 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+Blog(dict子类)与紧凑表示Blog.__row__(__slots__)的对比
+内存: tracemalloc统计构造N条记录的分配量；属性访问: 模板渲染listing时的典型访问blog.name、blog.summary、blog.created_at。
+
+用法: python benchmarks/bench_compact_rows.py [记录数]
+'''
+
+import os, sys, time, timeit, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import Blog, next_id
+
+def make_rows(n):
+	# 模拟数据库返回的字典，与Model.findAll中的cls(**r)一致
+	return [dict(id=next_id(), user_id=next_id(), user_name='user %s' % i, user_image='about:blank', \
+		name='blog %s' % i, summary='summary %s' % i, content='content %s' % i, created_at=time.time()) for i in range(n)]
+
+def measure_memory(make, rows):
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	objs = [make(**r) for r in rows]
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return objs, after - before
+
+def access(objs):
+	for b in objs:
+		b.name, b.summary, b.created_at
+
+def main(n):
+	rows = make_rows(n)
+	print('%-10s %14s %16s %18s' % ('class', 'bytes/row', 'build us/row', 'access ns/attr'))
+	for title, make in (('Blog', Blog), ('BlogRow', Blog.__row__)):
+		objs, size = measure_memory(make, rows)
+		build = min(timeit.repeat(lambda: [make(**r) for r in rows], number=5, repeat=3)) / 5 / n * 1e6
+		attr = min(timeit.repeat(lambda: access(objs), number=10, repeat=3)) / 10 / (n * 3) * 1e9
+		print('%-10s %14.1f %16.3f %18.1f' % (title, size / n, build, attr))
+
+if __name__ == '__main__':
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
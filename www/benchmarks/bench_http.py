@@ -0,0 +1,295 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+端到端HTTP benchmark
+使用sqlite内存数据库(orm的sqlite后端)启动app.init_app，写入指定数量的用户、博客和评论，
+然后对handlers中注册的每个@get/@post路由用concurrency个并发客户端各发送requests个请求，
+输出每个路由以及全部请求的req/s、p50/p95/p99延迟(毫秒)、合并的查询数(coalesced，orm的single-flight)和每个请求的内存分配，
+结果为JSON，可以保存下来在提交之间比较。
+
+内存分配在单独的一轮中统计(tracemalloc会明显拖慢请求，不与延迟同时统计)，客户端和服务端在同一个进程中，
+数字包含客户端的分配，只适合在提交之间比较:
+alloc_kb - 每个请求期间tracemalloc的峰值比请求开始时多出的KB
+retained_blocks - 每个请求之后仍然存活的内存块数(sys.getallocatedblocks的增量)，持续为正说明有缓存增长或者泄漏
+
+用法:
+python benchmarks/bench_http.py [--users 50] [--blogs 500] [--comments 2000] [--requests 200] [--concurrency 16] [--output result.json]
+python benchmarks/bench_http.py --compare old.json new.json
+'''
+
+import os, sys, time, json, random, hashlib, argparse, asyncio, itertools, subprocess, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+
+from config import configs
+# 在导入app之前切换到sqlite内存数据库，只输出警告以上的日志，关闭慢请求日志
+configs.db.backend = 'sqlite'
+configs.db.path = ':memory:'
+configs.logging.level = 'WARNING'
+for name in configs.logging.levels:
+	configs.logging.levels[name] = 'WARNING'
+configs.timing.slow_ms = 10 ** 9
+
+import app, handlers, orm
+from cache import response_cache
+from models import User, Blog, Comment, next_id
+
+ADMIN_EMAIL = 'admin@example.com'
+# 浏览器端提交的密码: sha1(email:password)
+ADMIN_PASSWD = hashlib.sha1(('%s:%s' % (ADMIN_EMAIL, 'benchmark')).encode('utf-8')).hexdigest()
+# 请求之前的预热次数，不计入结果
+WARMUP = 5
+
+class Context(object):
+	'''
+	测试数据，请求生成函数从这里取id
+	'''
+	def __init__(self):
+		self.admin = None
+		self.cookie = None
+		self.blog_ids = []
+		self.comment_ids = []
+		# 删除接口使用的记录，每个请求删除一条
+		self.victim_blogs = []
+		self.victim_comments = []
+		self.counter = itertools.count()
+
+def make_blog(user, i, size=500):
+	return Blog(user_id=user.id, user_name=user.name, user_image=user.image, name='blog %s' % i,
+		summary='summary of blog %s' % i, content=('# blog %s\n\ncontent ' % i) * (size // 20), created_at=time.time() - i)
+
+async def seed(ctx, users, blogs, comments, victims):
+	'''
+	写入测试数据
+	:victims:每个删除接口需要的记录数
+	'''
+	uid = next_id()
+	ctx.admin = User(id=uid, email=ADMIN_EMAIL, name='admin', admin=True, image='about:blank',
+		passwd=hashlib.sha1(('%s:%s' % (uid, ADMIN_PASSWD)).encode('utf-8')).hexdigest())
+	people = [ctx.admin] + [User(email='user%s@example.com' % i, name='user %s' % i, passwd='x' * 40, admin=False,
+		image='about:blank') for i in range(users - 1)]
+	await User.saveMany(people)
+	bs = [make_blog(random.choice(people), i) for i in range(blogs + victims)]
+	await Blog.saveMany(bs)
+	ctx.blog_ids = [b.id for b in bs[:blogs]]
+	ctx.victim_blogs = [b.id for b in bs[blogs:]]
+	cs = []
+	for i in range(comments + victims):
+		user = random.choice(people)
+		cs.append(Comment(blog_id=random.choice(ctx.blog_ids), user_id=user.id, user_name=user.name,
+			user_image=user.image, content='comment %s' % i, created_at=time.time() - i))
+	await Comment.saveMany(cs)
+	ctx.comment_ids = [c.id for c in cs[:comments]]
+	ctx.victim_comments = [c.id for c in cs[comments:]]
+	ctx.cookie = handlers.user2cookie(ctx.admin, 86400)
+
+def request_makers(ctx):
+	'''
+	每个路由的请求生成函数: (method, path) => 函数，返回(url, json数据|None)，POST请求必须带Content-Type，没有参数时发送{}
+	没有列出的GET路由把{id}替换为随机的博客id
+	'''
+	blog = lambda: random.choice(ctx.blog_ids)
+	page = lambda: random.randint(1, 5)
+	return {
+		('GET', '/'): lambda: ('/?page=%s' % page(), None),
+		('GET', '/api/users'): lambda: ('/api/users?page=%s' % page(), None),
+		('GET', '/api/blogs'): lambda: ('/api/blogs?page=%s' % page(), None),
+		('GET', '/api/comments'): lambda: ('/api/comments?page=%s' % page(), None),
+		('GET', '/manage/blogs'): lambda: ('/manage/blogs?page=%s' % page(), None),
+		('GET', '/manage/users'): lambda: ('/manage/users?page=%s' % page(), None),
+		('GET', '/manage/comments'): lambda: ('/manage/comments?page=%s' % page(), None),
+		('GET', '/manage/blogs/edit'): lambda: ('/manage/blogs/edit?id=%s' % blog(), None),
+		('POST', '/api/users'): lambda: ('/api/users', dict(email='bench%s@example.com' % next(ctx.counter),
+			name='bench', passwd=ADMIN_PASSWD)),
+		('POST', '/api/authenticate'): lambda: ('/api/authenticate', dict(email=ADMIN_EMAIL, passwd=ADMIN_PASSWD)),
+		('POST', '/api/blogs'): lambda: ('/api/blogs', dict(name='new blog', summary='summary', content='content ' * 50)),
+		('POST', '/api/blogs/{id}'): lambda: ('/api/blogs/%s' % blog(), dict(name='updated blog', summary='summary',
+			content='updated content %s' % next(ctx.counter))),
+		('POST', '/api/blogs/{id}/delete'): lambda: ('/api/blogs/%s/delete' % ctx.victim_blogs.pop(), {}),
+		('POST', '/api/post/{id}/comments'): lambda: ('/api/post/%s/comments' % blog(), dict(content='benchmark comment')),
+		('POST', '/api/comments/{id}/delete'): lambda: ('/api/comments/%s/delete' % ctx.victim_comments.pop(), {})
+	}
+
+def list_routes():
+	'''
+	与coroweb.add_routes相同的方式找出handlers中的路由
+	:return:[(method, path), ...]
+	'''
+	routes = []
+	for attr in dir(handlers):
+		fn = getattr(handlers, attr)
+		if not attr.startswith('_') and callable(fn) and getattr(fn, '__method__', None) and getattr(fn, '__route__', None):
+			routes.append((fn.__method__, fn.__route__))
+	return sorted(routes, key=lambda r: (r[1], r[0]))
+
+async def fetch(session, method, url, data, headers):
+	'''
+	:return:是否成功，状态码>=400或者返回APIError时为False
+	'''
+	async with session.request(method, url, json=data, headers=headers, allow_redirects=False) as resp:
+		body = await resp.read()
+		return resp.status < 400 and not body.startswith(b'{"error"')
+
+def percentile(values, p):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+async def run_route(session, base, headers, method, make, requests, concurrency):
+	for i in range(WARMUP):
+		url, data = make()
+		await fetch(session, method, base + url, data, headers)
+	latencies = []
+	errors = 0
+	todo = iter(range(requests))
+	async def client():
+		nonlocal errors
+		for i in todo:
+			url, data = make()
+			start = time.perf_counter()
+			ok = await fetch(session, method, base + url, data, headers)
+			latencies.append(time.perf_counter() - start)
+			if not ok:
+				errors += 1
+	start = time.perf_counter()
+	await asyncio.gather(*[client() for i in range(concurrency)])
+	return time.perf_counter() - start, latencies, errors
+
+async def measure_allocations(session, base, headers, method, make, requests):
+	peak = 0
+	blocks = sys.getallocatedblocks()
+	tracemalloc.start()
+	try:
+		for i in range(requests):
+			url, data = make()
+			tracemalloc.reset_peak()
+			current = tracemalloc.get_traced_memory()[0]
+			await fetch(session, method, base + url, data, headers)
+			peak += tracemalloc.get_traced_memory()[1] - current
+	finally:
+		tracemalloc.stop()
+	return peak / requests / 1024, (sys.getallocatedblocks() - blocks) / requests
+
+def summary(elapsed, latencies, errors):
+	return dict(requests=len(latencies), errors=errors, rps=round(len(latencies) / elapsed, 1) if elapsed else 0,
+		p50_ms=round(percentile(latencies, 50) * 1000, 3), p95_ms=round(percentile(latencies, 95) * 1000, 3),
+		p99_ms=round(percentile(latencies, 99) * 1000, 3))
+
+def git_revision():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+			stderr=subprocess.DEVNULL).decode().strip()
+	except Exception:
+		return None
+
+async def run(loop, args):
+	# 建表和写入测试数据在单独的任务中执行，写入状态(orm的contextvar)不会被之后创建的服务和请求继承
+	web_app = await asyncio.ensure_future(app.init_app(loop))
+	if args.no_response_cache:
+		response_cache.maxsize = 0
+	ctx = Context()
+	alloc_requests = args.alloc_requests
+	await asyncio.ensure_future(seed(ctx, args.users, args.blogs, args.comments, args.requests + WARMUP + alloc_requests))
+	handler = web_app.make_handler()
+	srv = await loop.create_server(handler, '127.0.0.1', 0)
+	base = 'http://127.0.0.1:%s' % srv.sockets[0].getsockname()[1]
+	headers = {'Cookie': '%s=%s' % (handlers.COOKIE_NAME, ctx.cookie)}
+	makers = request_makers(ctx)
+	blog = lambda: random.choice(ctx.blog_ids)
+	result = dict(revision=git_revision(), python=sys.version.split()[0], config=dict(users=args.users, blogs=args.blogs,
+		comments=args.comments, requests=args.requests, concurrency=args.concurrency, response_cache=not args.no_response_cache),
+		routes={}, skipped=[])
+	all_latencies = []
+	all_errors = 0
+	all_elapsed = 0
+	all_coalesced = 0
+	jar = aiohttp.DummyCookieJar() if hasattr(aiohttp, 'DummyCookieJar') else None
+	connector = aiohttp.TCPConnector(limit=args.concurrency)
+	async with aiohttp.ClientSession(connector=connector, cookie_jar=jar) as session:
+		for method, path in list_routes():
+			name = '%s %s' % (method, path)
+			if args.route and not any(r in name for r in args.route):
+				continue
+			make = makers.get((method, path))
+			if make is None:
+				if method != 'GET':
+					result['skipped'].append(name)
+					continue
+				make = lambda path=path: (path.replace('{id}', blog()), None)
+			coalesced = orm._select_coalesced.get()
+			elapsed, latencies, errors = await run_route(session, base, headers, method, make, args.requests, args.concurrency)
+			item = summary(elapsed, latencies, errors)
+			item['coalesced'] = orm._select_coalesced.get() - coalesced
+			all_coalesced += item['coalesced']
+			if alloc_requests:
+				item['alloc_kb'], item['retained_blocks'] = \
+					[round(v, 2) for v in await measure_allocations(session, base, headers, method, make, alloc_requests)]
+			result['routes'][name] = item
+			all_latencies.extend(latencies)
+			all_errors += errors
+			all_elapsed += elapsed
+			print('%-36s %8.1f req/s  p50 %7.2fms  p99 %7.2fms  coalesced %5s  errors %s' % (name, item['rps'], item['p50_ms'],
+				item['p99_ms'], item['coalesced'], errors), file=sys.stderr)
+	result['total'] = summary(all_elapsed, all_latencies, all_errors)
+	result['total']['coalesced'] = all_coalesced
+	if args.concurrency > 1 and not all_coalesced and configs.db.single_flight:
+		print('warning: no select was coalesced, the results do not include single-flight', file=sys.stderr)
+	srv.close()
+	await srv.wait_closed()
+	await web_app.shutdown()
+	await handler.shutdown(1.0)
+	await web_app.cleanup()
+	return result
+
+def compare(old_path, new_path):
+	'''
+	比较两次的结果: 每个路由的req/s和p99变化
+	'''
+	with open(old_path) as f:
+		old = json.load(f)
+	with open(new_path) as f:
+		new = json.load(f)
+	print('%s -> %s' % (old.get('revision'), new.get('revision')))
+	print('%-36s %12s %9s %12s %9s' % ('route', 'req/s', 'change', 'p99 ms', 'change'))
+	for name in sorted(set(old['routes']) | set(new['routes'])) + ['total']:
+		a = old['total'] if name == 'total' else old['routes'].get(name)
+		b = new['total'] if name == 'total' else new['routes'].get(name)
+		if a is None or b is None:
+			print('%-36s %s' % (name, 'only in ' + ('new' if a is None else 'old')))
+			continue
+		change = lambda x, y: '%+.1f%%' % ((y - x) * 100 / x) if x else '-'
+		print('%-36s %12.1f %9s %12.2f %9s' % (name, b['rps'], change(a['rps'], b['rps']), b['p99_ms'],
+			change(a['p99_ms'], b['p99_ms'])))
+
+def main():
+	parser = argparse.ArgumentParser(description='end-to-end HTTP benchmark of every handlers.py route')
+	parser.add_argument('--users', type=int, default=50)
+	parser.add_argument('--blogs', type=int, default=500)
+	parser.add_argument('--comments', type=int, default=2000)
+	parser.add_argument('--requests', type=int, default=200, help='requests per route')
+	parser.add_argument('--concurrency', type=int, default=16)
+	parser.add_argument('--alloc-requests', type=int, default=20, help='requests per route for the allocation pass, 0 to skip')
+	parser.add_argument('--no-response-cache', action='store_true', help='disable the rendered response cache')
+	parser.add_argument('--route', action='append', help='only routes containing this text, may be repeated')
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--output', help='write the JSON result to this file instead of stdout')
+	parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two JSON results')
+	args = parser.parse_args()
+	if args.compare:
+		compare(*args.compare)
+		return
+	random.seed(args.seed)
+	loop = asyncio.get_event_loop()
+	result = loop.run_until_complete(run(loop, args))
+	text = json.dumps(result, indent=2)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(text)
+	else:
+		print(text)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,140 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+RequestHandler参数绑定的微基准测试
+对比预编译参数绑定函数与原来通用的__call__实现，对handlers.py中的每个URL函数测量每次调用的开销。
+URL函数本身被替换为空函数，测量结果只包含参数绑定的开销。
+
+用法: python benchmarks/bench_request_handler.py [次数]
+'''
+
+import os, re, sys, time, asyncio, inspect, functools, logging
+from urllib import parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+
+from coroweb import RequestHandler
+from apis import APIError
+
+class LegacyRequestHandler(RequestHandler):
+	'''
+	预编译之前的RequestHandler.__call__实现，用于对比
+	'''
+	async def __call__(self, request):
+		logging.debug('RequestHandler content_type: %s, query_string: %s, match_info: %s' \
+			% (request.content_type, request.query_string, dict(**request.match_info)))
+		kw = None
+		if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
+			if request.method == 'POST':
+				if not request.content_type:
+					return web.HTTPBadRequest(text='Missing Content_Type.')
+				ct = request.content_type.lower()
+				if ct.startswith('application/json'):
+					params = await request.json()
+					if not isinstance(params, dict):
+						return web.HTTPBadRequest(text='JSON body must be object.')
+					kw = params
+				elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+					params = await request.post()
+					kw = dict(**params)
+				else:
+					return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+			if request.method == 'GET':
+				qs = request.query_string
+				if qs:
+					kw = dict()
+					for k, v in parse.parse_qs(qs, True).items():
+						kw[k] = v[0]
+		if kw is None:
+			kw = dict(**request.match_info)
+		else:
+			if not self._has_var_kw_arg and self._named_kw_args:
+				copy = dict()
+				for name in self._named_kw_args:
+					if name in kw:
+						copy[name] = kw[name]
+				kw = copy
+			for k, v in request.match_info.items():
+				if k in kw:
+					logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
+				kw[k] = v
+		if self._has_request_arg:
+			kw['request'] = request
+		if self._required_kw_args:
+			for name in self._required_kw_args:
+				if name not in kw:
+					return web.HTTPBadRequest(text='Missing argument: %s'%(name))
+		logging.info('call with args: %s' % str(kw))
+		try:
+			r = await self._func(**kw)
+			return r
+		except APIError as e:
+			return dict(error=e.error, data=e.data, message=e.message)
+
+class FakeRequest(object):
+	'''
+	只提供RequestHandler用到的属性
+	'''
+	def __init__(self, method, match_info, query_string='', body=None):
+		self.method = method
+		self.match_info = match_info
+		self.query_string = query_string
+		self.content_type = 'application/json' if method == 'POST' else ''
+		self._body = body
+
+	async def json(self):
+		return dict(self._body)
+
+	async def post(self):
+		return dict(self._body)
+
+def make_stub(fn):
+	'''
+	生成与fn签名相同的空函数
+	'''
+	@functools.wraps(fn)
+	async def stub(*args, **kw):
+		return None
+	return stub
+
+def make_request(fn):
+	'''
+	根据URL函数的路由和签名构造请求
+	'''
+	method, path = fn.__method__, fn.__route__
+	match_info = {name: '001' for name in re.findall(r'{(\w+)}', path)}
+	params = inspect.signature(fn).parameters
+	kw = {name: 'value' for name, p in params.items() \
+		if p.kind == inspect.Parameter.KEYWORD_ONLY and name not in match_info}
+	if method == 'POST':
+		return FakeRequest(method, match_info, body=kw)
+	return FakeRequest(method, match_info, query_string=parse.urlencode(kw))
+
+async def measure(handler, request, number):
+	start = time.perf_counter()
+	for _ in range(number):
+		await handler(request)
+	return (time.perf_counter() - start) / number * 1e6
+
+async def main(number):
+	import handlers
+	print('%-24s %-6s %-28s %10s %10s %8s' % ('handler', 'method', 'route', 'legacy(us)', 'binder(us)', 'speedup'))
+	for attr in dir(handlers):
+		fn = getattr(handlers, attr)
+		if attr.startswith('_') or not callable(fn) or not getattr(fn, '__route__', None):
+			continue
+		stub = make_stub(fn)
+		request = make_request(fn)
+		legacy = await measure(LegacyRequestHandler(None, stub), request, number)
+		binder = await measure(RequestHandler(None, stub), request, number)
+		print('%-24s %-6s %-28s %10.2f %10.2f %7.2fx' % (attr, fn.__method__, fn.__route__, legacy, binder, legacy / binder))
+
+if __name__ == '__main__':
+	# 与app.py一致，按INFO级别记录日志，但丢弃输出
+	logging.basicConfig(level=logging.INFO, stream=open(os.devnull, 'w'))
+	number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	asyncio.get_event_loop().run_until_complete(main(number))
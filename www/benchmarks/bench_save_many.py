@@ -0,0 +1,62 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+Model.saveMany/updateMany与循环调用save()/update()的对比
+使用config中配置的数据库，写入users表的测试记录在结束时删除。
+
+用法: python benchmarks/bench_save_many.py [记录数]
+'''
+
+import os, sys, time, asyncio, logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orm
+from config import configs
+from models import User, next_id
+
+EMAIL_PATTERN = 'bench-save-many-%s@example.com'
+
+def make_users(n, tag):
+	return [User(id=next_id(), email=EMAIL_PATTERN % ('%s-%s' % (tag, i)), passwd='0' * 40, \
+		admin=False, name='bench %s' % i, image='about:blank') for i in range(n)]
+
+async def timed(title, n, coro):
+	start = time.perf_counter()
+	rows = await coro
+	elapsed = time.perf_counter() - start
+	print('%-24s %8d rows %10.3f s %12.1f rows/s' % (title, rows, elapsed, n / elapsed))
+
+async def loop_save(users):
+	for u in users:
+		await u.save()
+	return len(users)
+
+async def loop_update(users):
+	for u in users:
+		await u.update()
+	return len(users)
+
+async def main(loop, n):
+	await orm.create_pool(loop=loop, **configs.db)
+	try:
+		users = make_users(n, 'loop')
+		await timed('loop save()', n, loop_save(users))
+		for u in users:
+			u.name = u.name + '!'
+		await timed('loop update()', n, loop_update(users))
+		users = make_users(n, 'many')
+		await timed('saveMany()', n, User.saveMany(users))
+		for u in users:
+			u.name = u.name + '!'
+		await timed('updateMany()', n, User.updateMany(users))
+	finally:
+		await orm.execute('DELETE FROM `users` WHERE `email` LIKE ?', [EMAIL_PATTERN % '%'])
+
+if __name__ == '__main__':
+	logging.getLogger().setLevel(logging.WARNING)
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(main(loop, n))
@@ -0,0 +1,48 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+api_blogs响应序列化的基准测试
+对比原来的json.dumps(default=lambda o: o.__dict__)与serializer的json、orjson后端，
+负载为dict(page=Page, blogs=[Blog, ...])，分别测试10、100、1000行。
+
+用法: python benchmarks/bench_serializer.py [次数]
+'''
+
+import os, sys, time, json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serializer
+from apis import Page
+from models import Blog, next_id
+
+def make_payload(rows):
+	blogs = [Blog(id=next_id(), user_id=next_id(), user_name='用户%s' % i, \
+		user_image='http://www.gravatar.com/avatar/%032d?d=mm&s=120' % i, name='博客标题 %s' % i, \
+		summary='摘要 ' * 20, content='正文内容 ' * 200, created_at=time.time() - i) for i in range(rows)]
+	return dict(page=Page(rows * 10, 1, rows), blogs=blogs)
+
+def legacy_dumps(obj):
+	return json.dumps(obj, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8')
+
+def measure(fn, payload, number):
+	start = time.perf_counter()
+	for _ in range(number):
+		fn(payload)
+	return (time.perf_counter() - start) / number * 1e6
+
+def main(number):
+	backends = [('legacy json', legacy_dumps), ('serializer json', serializer._json_dumps)]
+	if serializer.orjson is not None:
+		backends.append(('serializer orjson', serializer._orjson_dumps))
+	print('%6s %-20s %12s %10s' % ('rows', 'backend', 'us/call', 'bytes'))
+	for rows in (10, 100, 1000):
+		payload = make_payload(rows)
+		n = max(number // rows, 10)
+		for title, fn in backends:
+			print('%6d %-20s %12.1f %10d' % (rows, title, measure(fn, payload, n), len(fn(payload))))
+
+if __name__ == '__main__':
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
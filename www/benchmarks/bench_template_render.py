@@ -0,0 +1,72 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+大页面渲染期间其他请求的延迟: sync、async、thread三种渲染方式(templating.Renderer)的对比
+concurrency个协程不断渲染包含N篇博客的blogs.html，同时一个探测协程每1ms请求一次事件循环，
+探测到的额外等待时间就是此时其他请求(例如只读缓存的API)会多等的时间。
+
+用法: python benchmarks/bench_template_render.py [博客数] [并发数] [秒数]
+'''
+
+import os, sys, time, asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jinja2 import Environment, FileSystemLoader
+
+from apis import Page
+from templating import Renderer, RENDER_MODES
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates')
+
+def make_context(n):
+	now = time.time()
+	blogs = [dict(id='%050d' % i, name='blog %s' % i, summary='summary of blog %s ' % i * 10, created_at=now - i * 3600) \
+		for i in range(n)]
+	return dict(blogs=blogs, page=Page(n, 1, n), __user__=None)
+
+def percentile(values, p):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+async def run(mode, context, concurrency, seconds):
+	env = Environment(loader=FileSystemLoader(TEMPLATES), autoescape=True, enable_async=mode == 'async')
+	env.filters['datetime'] = lambda t: time.strftime('%Y-%m-%d', time.localtime(t))
+	renderer = Renderer(env, mode, concurrency)
+	deadline = time.perf_counter() + seconds
+	pages = 0
+
+	async def render():
+		nonlocal pages
+		while time.perf_counter() < deadline:
+			await renderer.render('blogs.html', context)
+			pages += 1
+
+	async def probe():
+		lags = []
+		while time.perf_counter() < deadline:
+			start = time.perf_counter()
+			await asyncio.sleep(0.001)
+			lags.append((time.perf_counter() - start - 0.001) * 1000)
+		return lags
+
+	tasks = [asyncio.ensure_future(render()) for i in range(concurrency)]
+	lags = await probe()
+	await asyncio.gather(*tasks)
+	renderer.shutdown()
+	return pages / seconds, lags
+
+def main(n, concurrency, seconds):
+	context = make_context(n)
+	loop = asyncio.get_event_loop()
+	print('blogs: %s, concurrency: %s, seconds: %s' % (n, concurrency, seconds))
+	print('%-8s %10s %12s %12s %12s' % ('mode', 'pages/s', 'lag p50 ms', 'lag p99 ms', 'lag max ms'))
+	for mode in RENDER_MODES:
+		rate, lags = loop.run_until_complete(run(mode, context, concurrency, seconds))
+		print('%-8s %10.1f %12.2f %12.2f %12.2f' % (mode, rate, percentile(lags, 50), percentile(lags, 99), max(lags or [0])))
+
+if __name__ == '__main__':
+	args = [int(a) for a in sys.argv[1:]]
+	main(*(args + [2000, 4, 3][len(args):]))
@@ -0,0 +1,117 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+orm读写路由的验证: 每次查询使用哪个连接池(按orm_pool_checkout_seconds的pool标签统计)
+缺省使用sqlite后端，主库和两个副本是三个独立的内存数据库(没有复制，只看路由)；
+--config时使用config中配置的数据库和副本，例如两个本地的MySQL/MariaDB实例，写入users表的测试记录在结束时删除。
+检查项:
+round_robin - 查询轮流使用各个副本，不使用主库
+least_busy - 一个副本的连接全部被占用时，查询使用其他副本
+read_your_writes - 同一个请求(identity_scope)写入之后的查询读主库，下一个请求恢复读副本
+use_primary - 块内的查询读主库
+
+用法: python benchmarks/check_replica_routing.py [--config] [--reads 20]
+'''
+
+import os, sys, asyncio, argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orm
+from config import configs
+from models import User, next_id
+
+def pool_options(args, policy):
+	if args.config:
+		options = dict(configs.db)
+	else:
+		options = dict(backend='sqlite', path=':memory:', replicas=[{'path': ':memory:'}, {'path': ':memory:'}])
+	# 逐个统计每次查询，不合并
+	options.update(replica_policy=policy, read_your_writes=True, single_flight=False)
+	return options
+
+def checkouts():
+	return {name: orm._pool_checkout.count((name,)) for name in orm._pool_names.values()}
+
+async def reads_by_pool(coro):
+	'''
+	:return:coro执行期间每个连接池的checkout次数，{pool标签: 次数}
+	'''
+	before = checkouts()
+	await coro
+	return {name: n - before.get(name, 0) for name, n in checkouts().items() if n > before.get(name, 0)}
+
+async def read(n=1):
+	for i in range(n):
+		await User.findAll(limit=1)
+
+def one_replica(got):
+	return len(got) == 1 and list(got)[0].startswith('replica') and list(got.values()) == [1]
+
+async def check(title, expected, coro):
+	'''
+	:expected:{pool标签: 次数}，或者判断结果的函数
+	:return:是否符合预期
+	'''
+	got = await reads_by_pool(coro)
+	ok = expected(got) if callable(expected) else got == expected
+	print('%-4s %-44s %s' % ('ok' if ok else 'FAIL', title, got))
+	return ok
+
+async def primary_read():
+	with orm.use_primary():
+		await read()
+
+async def run(loop, args, policy):
+	await orm.create_pool(loop, **pool_options(args, policy))
+	results = []
+	uid = next_id()
+	try:
+		if len(orm._replicas) < 2:
+			raise SystemExit('at least two replicas are required, check configs.db.replicas')
+		if not args.config:
+			await orm.create_tables()
+		print('%s:' % policy)
+		with orm.identity_scope():
+			if policy == 'round_robin':
+				half = args.reads // 2
+				results.append(await check('%s reads' % (half * 2), {'replica0': half, 'replica1': half}, read(half * 2)))
+			else:
+				# 占用replica0的全部连接，查询应该全部使用replica1
+				replica = orm._replicas[0]
+				conns = [await orm._backend.acquire(replica) for i in range(orm._backend.pool_stats(replica)[2])]
+				try:
+					results.append(await check('%s reads, replica0 busy' % args.reads, {'replica1': args.reads}, read(args.reads)))
+				finally:
+					for conn in conns:
+						await orm._backend.release(replica, conn)
+		with orm.identity_scope():
+			results.append(await check('read before write', one_replica, read()))
+			user = User(id=uid, email='check-replica-routing@example.com', passwd='0' * 40, admin=False, name='check', \
+				image='about:blank')
+			results.append(await check('write', {'primary': 1}, user.save()))
+			results.append(await check('read after write, same request', {'primary': 1}, read()))
+		with orm.identity_scope():
+			results.append(await check('read in the next request', one_replica, read()))
+			results.append(await check('use_primary', {'primary': 1}, primary_read()))
+	finally:
+		if args.config:
+			await orm.execute('DELETE FROM `users` WHERE `id` = ?', [uid])
+		await orm.close_pool()
+	return all(results)
+
+def main():
+	parser = argparse.ArgumentParser(description='check which pool the orm routes each statement to')
+	parser.add_argument('--config', action='store_true', help='use configs.db (with its replicas) instead of sqlite stand-ins')
+	parser.add_argument('--reads', type=int, default=20)
+	args = parser.parse_args()
+	loop = asyncio.get_event_loop()
+	ok = True
+	for policy in ('round_robin', 'least_busy'):
+		ok = loop.run_until_complete(run(loop, args, policy)) and ok
+	sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+	main()
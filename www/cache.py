@@ -0,0 +1,154 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+import time
+from collections import OrderedDict
+
+from config import configs
+import metrics
+
+class LRUCache(object):
+	'''
+	进程内的LRU缓存，每个条目可以有自己的过期时间
+	:maxsize:最大条目数，超过时淘汰最久未使用的条目
+	:ttl:缺省存活时间(秒)，None表示不过期
+	'''
+	def __init__(self, maxsize=1024, ttl=None):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		# key => (value, deadline)
+		self._data = OrderedDict()
+
+	def get(self, key, default=None):
+		'''
+		获取缓存条目，命中时将其移动到队尾
+		:key:缓存键
+		:default:未命中时返回的值
+		:return:缓存值|default
+		'''
+		item = self._data.get(key)
+		if item is not None:
+			value, deadline = item
+			if deadline is None or deadline > time.time():
+				self._data.move_to_end(key)
+				self.hits += 1
+				return value
+			del self._data[key]
+		self.misses += 1
+		return default
+
+	def set(self, key, value, ttl=None, expires=None):
+		'''
+		写入缓存条目
+		:key:缓存键
+		:value:缓存值
+		:ttl:本条目的存活时间(秒)，缺省使用self.ttl
+		:expires:本条目的绝对过期时间(unix时间戳)，与ttl同时存在时取较早者
+		:return:无
+		'''
+		if ttl is None:
+			ttl = self.ttl
+		deadline = None if ttl is None else time.time() + ttl
+		if expires is not None and (deadline is None or expires < deadline):
+			deadline = expires
+		self._data[key] = (value, deadline)
+		self._data.move_to_end(key)
+		while len(self._data) > self.maxsize:
+			self._data.popitem(last=False)
+
+	def pop(self, key, default=None):
+		'''
+		删除并返回缓存条目
+		:key:缓存键
+		:default:不存在时返回的值
+		:return:缓存值|default
+		'''
+		item = self._data.pop(key, None)
+		return default if item is None else item[0]
+
+	def discard_if(self, predicate):
+		'''
+		删除所有满足条件的条目
+		:predicate:函数predicate(key, value)，返回True的条目被删除
+		:return:删除的条目数
+		'''
+		keys = [k for k, (v, d) in self._data.items() if predicate(k, v)]
+		for k in keys:
+			del self._data[k]
+		return len(keys)
+
+	def clear(self):
+		self._data.clear()
+
+	def stats(self):
+		'''
+		缓存统计信息
+		:return:dict
+		'''
+		return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses)
+
+	def __len__(self):
+		return len(self._data)
+
+	def __str__(self):
+		return 'LRUCache size: %s, maxsize: %s, ttl: %s, hits: %s, misses: %s' % (\
+			len(self._data), self.maxsize, self.ttl, self.hits, self.misses)
+
+	__repr__ = __str__
+
+# 已验证的会话缓存: cookie字符串 => 脱敏后的user
+session_cache = LRUCache(configs.session.cache.maxsize, configs.session.cache.ttl)
+# 用户id => 会话缓存的代数，只记录发生过变化的用户
+_session_generations = {}
+
+def invalidate_user_sessions(uid):
+	'''
+	删除指定用户的所有会话缓存，用户的passwd或者admin发生变化时调用
+	:uid:用户id
+	:return:删除的条目数
+	'''
+	_session_generations[uid] = _session_generations.get(uid, 0) + 1
+	return session_cache.discard_if(lambda k, user: user.id == uid)
+
+def session_generation(uid):
+	'''
+	用户会话缓存的代数，每次invalidate_user_sessions加一。
+	验证cookie时在读取用户之前取得，写入会话缓存之前再比较，不同时说明读取期间用户发生了变化，读到的可能是旧记录，不能缓存
+	:uid:用户id
+	:return:int
+	'''
+	return _session_generations.get(uid, 0)
+
+# 渲染结果缓存: (path, query_string, user id) => (body, content_type, etag)
+response_cache = LRUCache(configs.response_cache.maxsize, configs.response_cache.ttl)
+# 渲染结果缓存的代数，invalidate_responses时加一
+_response_generation = 0
+
+def invalidate_responses():
+	'''
+	清空渲染结果缓存，博客发生变化时调用
+	:return:无
+	'''
+	global _response_generation
+	_response_generation += 1
+	response_cache.clear()
+
+def response_generation():
+	'''
+	渲染结果缓存的代数。调用handler之前取得，写入缓存之前再比较，不同时说明处理期间缓存被清空过，结果可能已经过时，不能缓存
+	:return:int
+	'''
+	return _response_generation
+
+# 输出到/internal/metrics的缓存: 名称 => LRUCache
+_caches = {'session': session_cache, 'response': response_cache}
+
+def _cache_stats(key):
+	return lambda: {(name, ): c.stats()[key] for name, c in _caches.items()}
+
+metrics.Gauge('cache_entries', 'Entries in each in-process cache.', ('cache',), fn=_cache_stats('size'))
+metrics.Counter('cache_hits_total', 'Lookups that found a live entry.', ('cache',), fn=_cache_stats('hits'))
+metrics.Counter('cache_misses_total', 'Lookups that found no live entry.', ('cache',), fn=_cache_stats('misses'))
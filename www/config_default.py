@@ -4,15 +4,102 @@ __author__ = "Sunshine'Z"
 
 configs = {
 	'debug': True,
+	# 日志级别，levels中按子系统(logger名)单独设置
+	'logging': {
+		'level': 'INFO',
+		'format': '%(asctime)s %(levelname)s %(name)s: %(message)s',
+		'levels': {
+			'app': 'INFO',
+			# 每个请求的日志
+			'app.request': 'WARNING',
+			# 超过timing.slow_ms的请求
+			'app.slow': 'WARNING',
+			'coroweb': 'INFO',
+			'handlers': 'INFO',
+			'launcher': 'INFO',
+			'markdowns': 'INFO',
+			'templating': 'INFO',
+			'orm': 'INFO',
+			# 每条SQL语句及返回行数
+			'orm.sql': 'WARNING'
+		}
+	},
 	'db': {
+		# 存储后端: mysql，sqlite - 标准库sqlite3，path为数据库文件，':memory:'为进程内的内存数据库
+		'backend': 'mysql',
+		'path': ':memory:',
 		'host': '127.0.0.1',
 		'port': 3306,
 		'user': 'root',
 		'password': '123456',
-		'db': 'awesome'
+		'db': 'awesome',
+		# Model总行数缓存的有效期(秒)，多个worker时其他worker的缓存要到过期才更新
+		'count_ttl': 60,
+		# saveMany/updateMany每条语句包含的最大记录数
+		'batch_size': 500,
+		# 只读副本，每一项覆盖上面的host、port等参数，例如[{'host': '127.0.0.1', 'port': 3307}]；
+		# sqlite后端的副本是独立的数据库(例如[{'path': ':memory:'}])，没有复制，用于验证路由，见benchmarks/check_replica_routing.py
+		'replicas': [],
+		# 选择副本的策略: round_robin或者least_busy
+		'replica_policy': 'round_robin',
+		# 写入之后同一个请求中的查询改为读主库
+		'read_your_writes': True,
+		# 合并并发执行的相同查询(事务中和本请求写入之后的查询除外)
+		'single_flight': True
 	},
 	'session': {
 		'name': 'awesession',
-		'secret': 'Awesome'
+		'secret': 'Awesome',
+		# 已验证会话的进程内缓存，ttl为秒
+		# 每个worker进程各自缓存，修改passwd或者admin时只清空处理该请求的worker，其他worker最多ttl秒内仍接受旧cookie
+		'cache': {
+			'maxsize': 10000,
+			'ttl': 300
+		}
+	},
+	# @get(..., cache=True)路由的渲染结果缓存，ttl为秒
+	# 每个worker进程各自缓存，博客修改后只清空处理该请求的worker，其他worker最多ttl秒内返回旧页面
+	'response_cache': {
+		'maxsize': 1000,
+		'ttl': 30
+	},
+	# JSON序列化后端: auto - 安装了orjson时使用orjson，orjson，json - 标准库
+	'json': {
+		'backend': 'auto'
+	},
+	# 博客内容的markdown渲染缓存，超过offload_size个字符的内容在workers个进程中渲染
+	'markdown': {
+		'cache_size': 1000,
+		'workers': 2,
+		'offload_size': 8192
+	},
+	# 模板: production - 生产模式，关闭auto_reload，使用字节码缓存(bytecode_cache为缓存目录，None使用系统临时目录)，启动时编译全部模板
+	# render - 渲染方式: sync - 在事件循环中渲染，async - render_async，thread - 在render_workers个线程中渲染
+	'jinja2': {
+		'production': False,
+		'bytecode_cache': None,
+		'render': 'sync',
+		'render_workers': 4
+	},
+	# 服务: workers - launcher启动的进程数，reuse_port - 每个进程使用SO_REUSEPORT各自监听，否则共享launcher预先绑定的socket，
+	# shutdown_timeout - 停止或重新加载时等待进行中请求完成的秒数
+	# 进程内缓存(session.cache、response_cache、Model总行数)不在worker之间同步，workers大于1时按各自的ttl过期
+	'server': {
+		'host': '127.0.0.1',
+		'port': 9001,
+		'workers': 1,
+		'reuse_port': False,
+		'backlog': 128,
+		'shutdown_timeout': 30
+	},
+	# 请求耗时: header - 是否输出Server-Timing响应头，slow_ms - 超过该耗时(毫秒)的请求写入慢请求日志
+	'timing': {
+		'header': True,
+		'slow_ms': 500
+	},
+	# /internal/metrics只允许管理员访问，token不为空时也接受请求头Authorization: Bearer <token>
+	# (服务通常在本机的反向代理之后，请求地址都是127.0.0.1，不能按地址限制)
+	'metrics': {
+		'token': None
 	}
 } 
\ No newline at end of file
@@ -7,10 +7,22 @@ from urllib import parse
 from aiohttp import web
 from apis import APIError
 
-def get(path):
+logger = logging.getLogger('coroweb')
+
+# 路由的访问类型
+# ACCESS_STATIC - 静态资源，不经过日志和用户认证中间件
+# ACCESS_ANONYMOUS - 匿名访问，不解析cookie，request.__user__总是None
+# ACCESS_AUTHENTICATED - 缺省值，解析cookie得到当前用户(用户可能为None)
+ACCESS_STATIC = 'static'
+ACCESS_ANONYMOUS = 'anonymous'
+ACCESS_AUTHENTICATED = 'authenticated'
+
+def get(path, *, access=ACCESS_AUTHENTICATED, cache=None):
 	'''
 	定义@get('/path')装饰器
 	:path:URL路径信息
+	:access:路由的访问类型
+	:cache:缓存渲染结果，True使用配置的缺省ttl，数字表示ttl(秒)
 	:return:返回装饰后的函数
 	'''
 	def decorator(func):
@@ -36,13 +48,16 @@ def get(path):
 			return func(*args, **kw)
 		wrapper.__method__ = 'GET'
 		wrapper.__route__ = path
+		wrapper.__access__ = access
+		wrapper.__cache__ = cache
 		return wrapper
 	return decorator
 
-def post(path):
+def post(path, *, access=ACCESS_AUTHENTICATED):
 	'''
 	定义@post('/path')装饰器
 	:path:URL路径信息
+	:access:路由的访问类型
 	:return:返回装饰后的函数
 	'''
 	def decorator(func):
@@ -51,6 +66,7 @@ def post(path):
 			return func(*args, **kw)
 		wrapper.__method__ = 'POST'
 		wrapper.__route__ = path
+		wrapper.__access__ = access
 		return wrapper
 	return decorator
 
@@ -157,9 +173,13 @@ class RequestHandler(object):
 	:app:Application is a synonym for web-server.
 	:fn:调用函数
 	'''
-	def __init__(self, app, fn):
+	def __init__(self, app, fn, access=ACCESS_AUTHENTICATED):
 		self._app = app
 		self._func = fn
+		# 路由的访问类型，中间件通过get_route_access读取
+		self.__access__ = access
+		# 渲染结果缓存设置，由response_factory读取
+		self.__cache__ = getattr(fn, '__cache__', None)
 		# 指定函数是否有request参数，并且request后面可以的参数只能是*args, **kw, * a, b ...
 		self._has_request_arg = has_request_arg(fn)
 		# 指定函数是否有关键字参数
@@ -170,85 +190,111 @@ class RequestHandler(object):
 		self._named_kw_args = get_named_kw_args(fn)
 		# 获取指定函数的没有默认值的命名关键字参数
 		self._required_kw_args = get_required_kw_args(fn)
+		# 根据函数签名和路由方法预先生成参数绑定函数，请求时只执行该函数需要的代码
+		self._bind = self._make_binder(getattr(fn, '__method__', None))
+
+	def _make_binder(self, method):
+		'''
+		生成参数绑定函数bind(request)，返回调用URL函数的kw，参数错误时抛出web.HTTPBadRequest
+		:method:路由的请求方法，GET或者POST，None表示两者都可能
+		:return:bind协程函数
+		'''
+		has_request_arg = self._has_request_arg
+		# 当函数参数没有关键字参数时，但是具有命名关键字参数，只保留命名关键字参数
+		named_kw_args = self._named_kw_args if not self._has_var_kw_arg else None
+		required_kw_args = self._required_kw_args
+		required = frozenset(required_kw_args)
+
+		def finish(kw, request):
+			if has_request_arg:
+				kw['request'] = request
+			# 假如命名关键字参数(没有默认值)，request没有提供相应的数值，报错
+			if required and not (kw.keys() >= required):
+				for name in required_kw_args:
+					if name not in kw:
+						raise web.HTTPBadRequest(text='Missing argument: %s' % name)
+			return kw
+
+		# 函数没有 关键字参数 也没有 命名关键字参数，只需要match_info
+		if not (self._has_var_kw_arg or self._has_named_kw_args or required_kw_args):
+			async def bind(request):
+				# match_info - Read-only property with AbstractMatchInfo instance for result of route resolving.
+				return finish(dict(request.match_info), request)
+			return bind
+
+		def merge(params, request):
+			if named_kw_args:
+				# remove all unamed kw:
+				kw = {name: params[name] for name in named_kw_args if name in params}
+			else:
+				kw = dict(params)
+			match_info = request.match_info
+			if match_info:
+				for k, v in match_info.items():
+					if k in kw:
+						logger.warning('Duplicate arg name in named arg and kw args: %s', k)
+					kw[k] = v
+			return finish(kw, request)
+
+		async def read_body(request):
+			# 查询看客户端有没有提交的数据格式
+			if not request.content_type:
+				# HTTPClientError
+				#  400 - HTTPBadRequest
+				raise web.HTTPBadRequest(text='Missing Content_Type.')
+			ct = request.content_type.lower()
+			if ct.startswith('application/json'):
+				# Read request body decoded as json.
+				params = await request.json()
+				if not isinstance(params, dict):
+					raise web.HTTPBadRequest(text='JSON body must be object.')
+				return params
+			if ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+				return await request.post()
+			raise web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+
+		def read_query(request):
+			# The query string in the URL, e.g., id=10
+			qs = request.query_string
+			if not qs:
+				return None
+			'''
+			parse_qs - Parse a query string given as a string argument 
+			(data of type application/x-www-form-urlencoded). Data are returned as a dictionary. 
+			The dictionary keys are the unique query variable names and the values are lists of 
+			values for each name.
+			
+			The optional argument keep_blank_values is a flag indicating whether blank values 
+			in percent-encoded queries should be treated as blank strings. 
+			'''
+			return {k: v[0] for k, v in parse.parse_qs(qs, True).items()}
+
+		if method == 'POST':
+			async def bind(request):
+				return merge(await read_body(request), request)
+		elif method == 'GET':
+			async def bind(request):
+				params = read_query(request)
+				if params is None:
+					return finish(dict(request.match_info), request)
+				return merge(params, request)
+		else:
+			async def bind(request):
+				if request.method == 'POST':
+					return merge(await read_body(request), request)
+				params = read_query(request) if request.method == 'GET' else None
+				if params is None:
+					return finish(dict(request.match_info), request)
+				return merge(params, request)
+		return bind
 
 	# 可以将实例视为函数
 	async def __call__(self, request):
-		logging.debug('RequestHandler content_type: %s, query_string: %s, match_info: %s' \
-			% (request.content_type, request.query_string, dict(**request.match_info)))
-		kw = None
-		# 如果函数有 关键字参数 或者 命名关键字参数 或者 没有默认值的命名关键字参数
-		if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-			# 判断客户端发来的方法是否为POST
-			if request.method == 'POST':
-				# 查询看客户端有没有提交的数据格式
-				if not request.content_type:
-					# HTTPClientError
-					#  400 - HTTPBadRequest
-					return web.HTTPBadRequest(text='Missing Content_Type.')
-				ct = request.content_type.lower()
-				if ct.startswith('application/json'):
-					# Read request body decoded as json.
-					params = await request.json()
-					if not isinstance(params, dict):
-						return web.HTTPBadRequest('JSON body must be object.')
-					kw = params
-				elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-					params = await request.post()
-					kw = dict(**params)
-				else:
-					return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
-			if request.method == 'GET':
-				# The query string in the URL, e.g., id=10
-				qs = request.query_string
-				if qs:
-					kw = dict()
-					'''
-					example
-					>>> from urllib.parse import urlparse
-					>>> o = urlparse('http://www.cwi.nl:80/%7Eguido/Python.html')
-					>>> o   
-					ParseResult(scheme='http', netloc='www.cwi.nl:80', path='/%7Eguido/Python.html',
-					params='', query='', fragment='')
-					
-					parse_qs - Parse a query string given as a string argument 
-					(data of type application/x-www-form-urlencoded). Data are returned as a dictionary. 
-					The dictionary keys are the unique query variable names and the values are lists of 
-					values for each name.
-					
-					The optional argument keep_blank_values is a flag indicating whether blank values 
-					in percent-encoded queries should be treated as blank strings. 
-					A true value indicates that blanks should be retained as blank strings. 
-					The default false value indicates that blank values are to be ignored and treated as 
-					if they were not included.
-					'''
-					for k, v in parse.parse_qs(qs, True).items():
-						kw[k] = v[0]
-		if kw is None:
-			# match_info - Read-only property with AbstractMatchInfo instance for result of route resolving.
-			kw = dict(**request.match_info)
-		else:
-			# 当函数参数没有关键字参数时，但是具有命名关键字参数
-			# 对于函数而言命名关键字参数必须要有
-			if not self._has_var_kw_arg and self._named_kw_args:
-				# remove all unamed kw:
-				copy = dict()
-				# 遍历命名关键字参数
-				for name in self._named_kw_args:
-					if name in kw:
-						copy[name] = kw[name]
-				kw = copy
-			for k, v in request.match_info.items():
-				if k in kw:
-					logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
-				kw[k] = v
-		if self._has_request_arg:
-			kw['request'] = request
-		if self._required_kw_args:
-			# 假如命名关键字参数(没有默认值)，request没有提供相应的数值，报错
-			for name in self._required_kw_args:
-				if name not in kw:
-					return web.HTTPBadRequest(text='Missing argument: %s'%(name))
-		logging.info('call with args: %s' % str(kw))
+		try:
+			kw = await self._bind(request)
+		except web.HTTPBadRequest as e:
+			return e
+		logger.debug('call with args: %s', kw)
 		try:
 			r = await self._func(**kw)
 			return r
@@ -256,9 +302,9 @@ class RequestHandler(object):
 			return dict(error=e.error, data=e.data, message=e.message)
 
 	def __str__(self):
-		return 'RequestHandler self: %s, app: %s, fn: %s, has_request_arg: %s, has_var_kw_arg: %s, \
+		return 'RequestHandler self: %s, app: %s, fn: %s, access: %s, has_request_arg: %s, has_var_kw_arg: %s, \
 		has_named_kw_args: %s, named_kw_args: %s, required_kw_args: %s' % (\
-			hex(id(self)), self._app, self._func, self._has_request_arg, self._has_var_kw_arg, \
+			hex(id(self)), self._app, self._func, self.__access__, self._has_request_arg, self._has_var_kw_arg, \
 			self._has_named_kw_args, self._named_kw_args, self._required_kw_args)
 
 def add_static(app):
@@ -279,31 +325,65 @@ def add_static(app):
 	router.add_static - Adds a router and a handler for returning static files.
 	'''
 	app.router.add_static('/static/', path)
-	logging.info('add static %s => %s' % ('/static/', path))
+	add_access_prefix(app, '/static/', ACCESS_STATIC)
+	logger.info('add static %s => %s', '/static/', path)
+
+def add_access_prefix(app, prefix, access):
+	'''
+	按URL前缀指定路由的访问类型，用于没有经过@get/@post装饰的路由(例如静态文件)
+	:app:Application is a synonym for web-server.
+	:prefix:URL前缀
+	:access:路由的访问类型
+	:return:无
+	'''
+	prefixes = app.get('__access_prefixes__')
+	if prefixes is None:
+		prefixes = app['__access_prefixes__'] = []
+	prefixes.append((prefix, access))
+	logger.info('add access prefix %s => %s', prefix, access)
+
+def get_route_access(request):
+	'''
+	获取请求对应路由的访问类型
+	:request:The Request object contains all the information about an incoming HTTP request.
+	:return:访问类型
+	'''
+	# match_info.handler - 路由解析得到的处理函数，对于add_route注册的路由就是RequestHandler
+	access = getattr(request.match_info.handler, '__access__', None)
+	if access is not None:
+		return access
+	path = request.path
+	for prefix, access in request.app.get('__access_prefixes__', ()):
+		if path.startswith(prefix):
+			return access
+	return ACCESS_AUTHENTICATED
 
-def add_route(app, fn):
+def add_route(app, fn, access=None):
 	'''
 	用来注册一个URL处理函数
 	:app:Application is a synonym for web-server.]
 	:fn:导入的函数
+	:access:路由的访问类型，缺省使用@get/@post中指定的值
 	:return:无
 	'''
 	method = getattr(fn, '__method__', None)
 	path = getattr(fn, '__route__', None)
+	if access is None:
+		access = getattr(fn, '__access__', ACCESS_AUTHENTICATED)
 	if path is None or method is None:
 		raise ValueError('@get or @post not defined in %s.' % str(fn))
 	if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
 		fn = asyncio.coroutine(fn)
-	logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ', \
-		'.join(inspect.signature(fn).parameters.keys())))
+	logger.info('add route %s %s => %s(%s)', method, path, fn.__name__, ', \
+		'.join(inspect.signature(fn).parameters.keys()))
 	'''
 	add_route(method, path, handler, *, name=None, expect_handler=None)
 	Append handler to the end of route table.
 
 	'''
-	RH = RequestHandler(app, fn)
+	RH = RequestHandler(app, fn, access)
 	app.router.add_route(method, path, RH)
-	logging.debug('add_route RequestHandler: %s' % RH)
+	logger.debug('add_route RequestHandler: %s', RH)
 
 def add_routes(app, moudle_name):
 	'''
@@ -326,6 +406,6 @@ def add_routes(app, moudle_name):
 			method = getattr(fn, '__method__', None)
 			path = getattr(fn, '__route__', None)
 			if method and path:
-				logging.debug('add_routes fn.__name__: %s, fn.__method__: %s, fn.__route__: %s' \
-					% (fn.__name__, fn.__method__, fn.__route__))
+				logger.debug('add_routes fn.__name__: %s, fn.__method__: %s, fn.__route__: %s', \
+					fn.__name__, fn.__method__, fn.__route__)
 				add_route(app, fn)
@@ -2,21 +2,26 @@
 
 __author__ = "Sunshine'Z"
 
-import re, time, json, logging, hashlib, base64, asyncio
+import re, time, hmac, logging, hashlib, base64, asyncio
 
 import markdown2
 
 from aiohttp import web
 
-from coroweb import get, post
-from apis import Page, APIValueError, APIResourceNotFoundError, APIPermissionError
+from coroweb import get, post, ACCESS_ANONYMOUS
+from apis import Page, APIValueError, APIResourceNotFoundError, APIPermissionError, decode_cursor
 
+import orm, serializer, metrics
 from models import User, Comment, Blog, next_id
 from config import configs
+from cache import session_cache, session_generation, invalidate_responses
+from markdowns import markdown2html
 
 COOKIE_NAME = configs.session.name
 _COOKIE_KEY = configs.session.secret
 
+logger = logging.getLogger('handlers')
+
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 
@@ -44,6 +49,24 @@ def get_page_index(page_str):
 		p = 1
 	return p
 
+async def find_page(model, page, orderBy, **kw):
+	'''
+	查询一页记录，page.cursor存在时使用keyset分页代替LIMIT offset
+	:model:Model类
+	:page:Page对象
+	:orderBy:排序字段，例如'created_at DESC'
+	:kw:其他findAll参数
+	:return:记录集合
+	'''
+	field, order = model.keyset(orderBy)
+	if page.cursor:
+		items = await model.findAll(orderBy=orderBy, limit=page.limit, after=decode_cursor(page.cursor), **kw)
+	else:
+		# 与keyset分页相同的(排序字段, 主键)排序，下一页的游标才不会跳过排序字段相同的记录
+		items = await model.findAll(orderBy=order, limit=(page.offset, page.limit), **kw)
+	page.set_next_cursor(items, field)
+	return items
+
 def check_admin(request):
 	'''
 	检查当前登陆用户是否管理员
@@ -79,6 +102,10 @@ async def cookie2user(cookie_str):
 	'''
 	if not cookie_str:
 		return None
+	# 已验证过的cookie直接从缓存返回，缓存条目不会晚于cookie的expires过期
+	user = session_cache.get(cookie_str)
+	if user is not None:
+		return User(**user)
 	try:
 		L = cookie_str.split('-')
 		if len(L) != 3:
@@ -86,20 +113,28 @@ async def cookie2user(cookie_str):
 		uid, expires, sha1 = L
 		if int(expires) < time.time():
 			return None
-		user = await User.find(uid)
+		generation = session_generation(uid)
+		# 读主库: 修改passwd或者admin之后清空了会话缓存，从落后的副本读到旧记录会让旧cookie重新进入缓存
+		with orm.use_primary():
+			user = await User.find(uid)
 		if user is None:
 			return None
 		s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
 		if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
-			logging.info('invalid sha1')
+			logger.info('invalid sha1')
 			return None
+		# user可能是本请求identity map中的对象，复制之后再隐藏passwd
+		user = User(**user)
 		user.passwd = '******'
-		return user
+		# 读取期间用户被修改(会话缓存已经清空)，读到的可能是旧记录，本次验证结果不缓存
+		if session_generation(uid) == generation:
+			session_cache.set(cookie_str, user, expires=int(expires))
+		return User(**user)
 	except Exception as e:
-		logging.exception(e)
+		logger.exception(e)
 		return None
 
-@get('/')
+@get('/', cache=True)
 async def index(*, page='1'):
 	'''
 	首页
@@ -108,30 +143,31 @@ async def index(*, page='1'):
 	'''
 	page_index = get_page_index(page)
 	num = await Blog.findNumber('COUNT(id)')
-	page = Page(num)
+	page = Page(num, page_index)
 	if num == 0:
 		blogs = []
 	else:
-		blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+		blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit), compact=True)
 	return {
 		'__template__': 'blogs.html',
 		'page': page,
 		'blogs': blogs
 	}	
 
-@get('/api/users')
-async def api_get_users(*, page='1'):
+@get('/api/users', access=ACCESS_ANONYMOUS)
+async def api_get_users(*, page='1', cursor=None):
 	'''
 	根据页码获取博客的用户
 	:page:页码
+	:cursor:keyset分页的游标，来自上一页的page.next_cursor
 	:return:dict
 	'''
 	page_index = get_page_index(page)
 	num = await User.findNumber('COUNT(id)')
-	p = Page(num, page_index)
+	p = Page(num, page_index, cursor=cursor)
 	if num == 0:
 		return dict(page=p, users=())
-	users = await User.findAll(orderBy='created_at DESC', limit=(p.offset, p.limit))
+	users = await find_page(User, p, 'created_at DESC')
 	for u in users:
 		u.passwd = '******'
 	return dict(page=p, users=users)
@@ -156,7 +192,7 @@ def signin():
 		'__template__':'signin.html'
 	}
 
-@post('/api/users')
+@post('/api/users', access=ACCESS_ANONYMOUS)
 async def api_register_user(*, email, name, passwd):
 	'''
 	注册
@@ -184,10 +220,10 @@ async def api_register_user(*, email, name, passwd):
 	r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
 	user.passwd = '******'
 	r.content_type = 'application/json'
-	r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+	r.body = serializer.dumps(user)
 	return r
 
-@post('/api/authenticate')
+@post('/api/authenticate', access=ACCESS_ANONYMOUS)
 async def authenticate(*, email, passwd):
 	'''
 	登陆验证
@@ -215,10 +251,10 @@ async def authenticate(*, email, passwd):
 	r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
 	user.passwd = '******'
 	r.content_type = 'application/json'
-	r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+	r.body = serializer.dumps(user)
 	return r
 
-@get('/signout')
+@get('/signout', access=ACCESS_ANONYMOUS)
 async def signout(request):
 	'''
 	登出
@@ -234,7 +270,7 @@ async def signout(request):
 	# To redirect user to another endpoint 
 	r = web.HTTPFound(referer or '/')
 	r.set_cookie(COOKIE_NAME, '-deleted-', max_age=0, httponly=True)
-	logging.info('user signed out.')
+	logger.info('user signed out.')
 	return r
 
 @get('/manage/blogs/create')
@@ -270,6 +306,7 @@ async def api_create_blog(request, *, name, summary, content):
 		user_image = request.__user__.image, name = name.strip(), \
 		summary=summary.strip(), content=content.strip())
 	await blog.save()
+	invalidate_responses()
 	return blog
 
 @get('/manage/blogs')
@@ -284,30 +321,33 @@ async def manage_blogs(*, page = '1'):
 		'page_index': get_page_index(page)
 	}
 
-@get('/api/blogs/{id}')
+@get('/api/blogs/{id}', access=ACCESS_ANONYMOUS, cache=True)
 async def api_get_blog(*, id):
 	'''
 	根据ID获取指定博客的API
 	:id:博客ID
 	:return:blog info
 	'''
-	logging.debug('api_get_blog id: %s' % id)
+	logger.debug('api_get_blog id: %s', id)
 	blog = await Blog.find(id)
+	if blog is not None:
+		blog.html_content = await markdown2html(blog.content)
 	return blog
 
-@get('/api/blogs')
-async def api_blogs(*, page = '1'):
+@get('/api/blogs', access=ACCESS_ANONYMOUS, cache=True)
+async def api_blogs(*, page = '1', cursor = None):
 	'''
 	根据页码获取博客的API
 	:page:页码
+	:cursor:keyset分页的游标，来自上一页的page.next_cursor
 	:return:blog info
 	'''
 	page_index = get_page_index(page)
 	num = await Blog.findNumber('COUNT(id)')
-	p = Page(num, page_index)
+	p = Page(num, page_index, cursor=cursor)
 	if num == 0:
 		return dict(page=p, blogs=())
-	blogs = await Blog.findAll(orderBy='created_at DESC', limit=(p.offset, p.limit))
+	blogs = await find_page(Blog, p, 'created_at DESC', compact=True)
 	return dict(page=p, blogs=blogs)
 
 @get('/manage/blogs/edit')
@@ -333,7 +373,14 @@ async def api_delete_blog(request, *, id):
 	'''
 	check_admin(request)
 	blog = await Blog.find(id)
-	await blog.remove()
+	if blog is None:
+		raise APIResourceNotFoundError('Blog')
+	# 博客和它的评论在同一个事务中删除
+	async with orm.transaction():
+		await blog.remove()
+		await orm.execute('DELETE FROM `comments` WHERE `blog_id` = ?', [id])
+	Comment.resetCount()
+	invalidate_responses()
 	return dict(id=id)
 
 @post('/api/blogs/{id}')
@@ -359,6 +406,7 @@ async def api_update_blog(request, *, id, name, summary, content):
 	blog.summary = summary.strip()
 	blog.content = content.strip()
 	await blog.update()
+	invalidate_responses()
 	return blog
 
 @get('/manage/users')
@@ -385,21 +433,32 @@ async def manage_comments(*, page='1'):
 		'page_index': get_page_index(page)
 	}
 
-@get('/api/comments')
-async def api_comments(*, page = '1'):
+@get('/api/comments', access=ACCESS_ANONYMOUS)
+async def api_comments(*, page = '1', cursor = None):
 	'''
 	根据页码获取博客的评论
 	:page:页码
+	:cursor:keyset分页的游标，来自上一页的page.next_cursor
 	:return:comment info
 	'''
 	page_index = get_page_index(page)
 	num = await Comment.findNumber('COUNT(id)')
-	p = Page(num, page_index)
+	p = Page(num, page_index, cursor=cursor)
 	if num == 0:
 		return dict(page=p, comments=())
-	comments = await Comment.findAll(orderBy='created_at', limit=(p.offset, p.limit))
+	comments = await find_page(Comment, p, 'created_at')
 	return dict(page=p, comments=comments)
 
+@get('/api/comments/export')
+async def api_export_comments(request):
+	'''
+	导出全部评论，使用服务端游标逐条读取并以JSON数组流式输出
+	:request:The Request object contains all the information about an incoming HTTP request.
+	:return:comment info
+	'''
+	check_admin(request)
+	return await Comment.findAll(orderBy='created_at', stream=True)
+
 @post('/api/post/{id}/comments')
 async def api_create_comment(request, *, id, content):
 	'''
@@ -433,5 +492,18 @@ async def api_delete_comments(request, *, id):
 	c = await Comment.find(id)
 	if c is None:
 		raise APIResourceNotFoundError('Comment')
-	c.remove()
-	return dict(id=id)
\ No newline at end of file
+	await c.remove()
+	return dict(id=id)
+
+@get('/internal/metrics')
+async def internal_metrics(request):
+	'''
+	Prometheus格式的运行指标(连接池、查询耗时等)，只允许管理员访问；
+	配置了configs.metrics.token时也可以用请求头Authorization: Bearer <token>访问(给Prometheus抓取用)
+	:request:The Request object contains all the information about an incoming HTTP request.
+	:return:text/plain
+	'''
+	token = configs.metrics.token
+	if not token or not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer %s' % token):
+		check_admin(request)
+	return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
\ No newline at end of file
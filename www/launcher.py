@@ -0,0 +1,273 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+多进程启动器
+主进程启动configs.server.workers个worker进程，每个worker有自己的事件循环和数据库连接池。
+监听方式:
+reuse_port为False - 主进程预先绑定socket，worker继承该socket，重新加载时队列中的连接不会丢失
+reuse_port为True - 每个worker使用SO_REUSEPORT各自绑定，由内核在进程间分配连接，worker退出时其队列中未accept的连接会被重置
+信号:
+SIGHUP - 重新加载: 启动新一代worker(重新读取代码和配置)，全部就绪后再让旧worker处理完进行中的请求后退出；
+新worker启动失败时旧worker继续服务。host、port和workers由主进程读取，修改后需要重启主进程
+SIGTERM/SIGINT - 停止所有worker后退出
+worker意外退出时自动重启，启动后1秒内退出的worker延迟重启，避免反复崩溃占满CPU
+限制: 进程内缓存不在worker之间同步，写入请求只清空处理它的worker的缓存。workers大于1时，
+修改passwd或者admin之后其他worker最多session.cache.ttl秒(缺省300)内仍接受旧cookie，
+博客修改之后其他worker最多response_cache.ttl秒(缺省30)内返回旧页面，Model总行数最多db.count_ttl秒内不更新；
+不能接受时调小这些ttl
+
+用法: python launcher.py
+'''
+
+import os, sys, time, signal, select, socket, asyncio, logging, argparse, subprocess
+
+from config import configs
+
+logger = logging.getLogger('launcher')
+
+# 启动后存活不到该秒数即退出，视为启动失败，延迟重启
+_MIN_UPTIME = 1
+# 延迟重启的等待秒数
+_RESPAWN_DELAY = 1
+
+def bind_socket(host, port, reuse_port=False, backlog=128):
+	'''
+	创建并绑定监听socket
+	:host:地址
+	:port:端口
+	:reuse_port:是否设置SO_REUSEPORT
+	:backlog:等待accept的连接队列长度
+	:return:socket
+	'''
+	sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	if reuse_port:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+	sock.bind((host, port))
+	sock.listen(backlog)
+	sock.setblocking(False)
+	return sock
+
+class Worker(object):
+	'''
+	worker进程
+	:process:subprocess.Popen
+	:generation:所属的代，每次重新加载加一
+	:started:启动时间
+	:ready:是否已经开始监听
+	:retired:是否已经通知退出
+	'''
+	def __init__(self, process, generation):
+		self.process = process
+		self.generation = generation
+		self.started = time.time()
+		self.ready = False
+		self.retired = False
+
+	@property
+	def pid(self):
+		return self.process.pid
+
+class Master(object):
+	'''
+	主进程: 启动、监控、重新加载和停止worker
+	:workers:worker进程数
+	:sock:共享的监听socket，reuse_port方式时为None
+	'''
+	def __init__(self, workers, sock=None):
+		self.count = workers
+		self.sock = sock
+		self.generation = 0
+		self.workers = {}
+		# 延迟重启的时间列表
+		self._respawns = []
+		self._signals = []
+		self._stopping = False
+		# worker就绪时写入自己的pid
+		self._ready_r, self._ready_w = os.pipe()
+
+	def spawn(self):
+		'''
+		启动一个当前代的worker
+		:return:Worker
+		'''
+		args = [sys.executable, os.path.abspath(__file__), '--worker', '--ready', str(self._ready_w)]
+		fds = [self._ready_w]
+		if self.sock is not None:
+			args += ['--fd', str(self.sock.fileno())]
+			fds.append(self.sock.fileno())
+		process = subprocess.Popen(args, pass_fds=fds)
+		worker = Worker(process, self.generation)
+		self.workers[worker.pid] = worker
+		logger.info('worker %s started, generation: %s', worker.pid, worker.generation)
+		return worker
+
+	def reload(self):
+		'''
+		启动新一代worker，旧worker在新worker全部就绪后退出
+		:return:无
+		'''
+		self.generation += 1
+		self._respawns = []
+		logger.info('reloading, generation: %s', self.generation)
+		for i in range(self.count):
+			self.spawn()
+
+	def stop(self, timeout):
+		'''
+		通知所有worker退出，超过timeout秒仍未退出的强制结束
+		:timeout:等待秒数
+		:return:无
+		'''
+		self._stopping = True
+		logger.info('stopping %s workers...', len(self.workers))
+		for worker in self.workers.values():
+			self._retire(worker)
+		deadline = time.time() + timeout
+		for worker in list(self.workers.values()):
+			try:
+				worker.process.wait(max(0, deadline - time.time()))
+			except subprocess.TimeoutExpired:
+				logger.warning('worker %s did not exit in %ss, killing', worker.pid, timeout)
+				worker.process.kill()
+				worker.process.wait()
+		self.workers.clear()
+
+	def _retire(self, worker):
+		if not worker.retired and worker.process.poll() is None:
+			worker.retired = True
+			worker.process.send_signal(signal.SIGTERM)
+
+	def _reap(self):
+		# 回收已经退出的worker，当前代非主动退出的worker需要重启
+		now = time.time()
+		for worker in list(self.workers.values()):
+			code = worker.process.poll()
+			if code is None:
+				continue
+			del self.workers[worker.pid]
+			if worker.retired or self._stopping:
+				logger.info('worker %s exited with code %s', worker.pid, code)
+				continue
+			logger.warning('worker %s died with code %s', worker.pid, code)
+			if worker.generation != self.generation:
+				continue
+			if now - worker.started < _MIN_UPTIME:
+				self._respawns.append(now + _RESPAWN_DELAY)
+			else:
+				self.spawn()
+
+	def _read_ready(self, timeout):
+		# 等待worker的就绪通知，同时作为主循环的定时器
+		try:
+			r, w, x = select.select([self._ready_r], [], [], timeout)
+		except InterruptedError:
+			return
+		if not r:
+			return
+		for line in os.read(self._ready_r, 4096).split():
+			worker = self.workers.get(int(line))
+			if worker is not None:
+				worker.ready = True
+				logger.info('worker %s ready', worker.pid)
+
+	def _retire_old(self):
+		# 当前代的worker全部就绪后，旧worker退出
+		current = [w for w in self.workers.values() if w.generation == self.generation]
+		if len(current) < self.count or not all(w.ready for w in current):
+			return
+		for worker in self.workers.values():
+			if worker.generation != self.generation:
+				self._retire(worker)
+
+	def _on_signal(self, signum, frame):
+		self._signals.append(signum)
+
+	def run(self):
+		'''
+		主循环，收到SIGTERM/SIGINT时返回
+		:return:无
+		'''
+		for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+			signal.signal(signum, self._on_signal)
+		for i in range(self.count):
+			self.spawn()
+		while True:
+			while self._signals:
+				signum = self._signals.pop(0)
+				if signum == signal.SIGHUP:
+					self.reload()
+				else:
+					return
+			self._read_ready(0.5)
+			self._reap()
+			now = time.time()
+			due = [t for t in self._respawns if t <= now]
+			if due:
+				self._respawns = [t for t in self._respawns if t > now]
+				for t in due:
+					self.spawn()
+			self._retire_old()
+
+def run_worker(fd=None, ready=None):
+	'''
+	worker进程: 创建web应用并在监听socket上提供服务，收到SIGTERM后停止接受新连接，
+	等待进行中的请求完成(最多configs.server.shutdown_timeout秒)后退出
+	:fd:继承的监听socket的文件描述符，None时使用SO_REUSEPORT自行绑定
+	:ready:就绪通知管道的文件描述符
+	:return:无
+	'''
+	# 终端的Ctrl-C同时发给整个进程组，由主进程统一停止worker
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGHUP, signal.SIG_IGN)
+	import app
+	server = configs.server
+	if fd is None:
+		sock = bind_socket(server.host, server.port, reuse_port=True, backlog=server.backlog)
+	else:
+		sock = socket.socket(fileno=fd)
+	loop = asyncio.get_event_loop()
+	web_app = loop.run_until_complete(app.init_app(loop))
+	handler = web_app.make_handler()
+	srv = loop.run_until_complete(loop.create_server(handler, sock=sock))
+	loop.add_signal_handler(signal.SIGTERM, loop.stop)
+	logger.info('worker %s serving on %s', os.getpid(), sock.getsockname())
+	if ready is not None:
+		os.write(ready, b'%d\n' % os.getpid())
+		os.close(ready)
+	loop.run_forever()
+	logger.info('worker %s shutting down...', os.getpid())
+	srv.close()
+	loop.run_until_complete(srv.wait_closed())
+	loop.run_until_complete(web_app.shutdown())
+	loop.run_until_complete(handler.shutdown(server.shutdown_timeout))
+	loop.run_until_complete(web_app.cleanup())
+	loop.close()
+
+def main():
+	parser = argparse.ArgumentParser(description='awesome multi-process launcher')
+	parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+	parser.add_argument('--fd', type=int, help=argparse.SUPPRESS)
+	parser.add_argument('--ready', type=int, help=argparse.SUPPRESS)
+	args = parser.parse_args()
+	if args.worker:
+		run_worker(args.fd, args.ready)
+		return
+	import logs
+	logs.init_logging(**configs.logging)
+	server = configs.server
+	sock = None
+	if not server.reuse_port:
+		sock = bind_socket(server.host, server.port, backlog=server.backlog)
+	logger.info('listening at http://%s:%s, workers: %s, reuse_port: %s', server.host, server.port, server.workers, server.reuse_port)
+	master = Master(server.workers, sock)
+	try:
+		master.run()
+	finally:
+		master.stop(server.shutdown_timeout + 5)
+	logger.info('launcher stopped')
+
+if __name__ == '__main__':
+	main()
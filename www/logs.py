@@ -0,0 +1,26 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+日志配置
+每个子系统使用自己的logger(app、app.request、coroweb、handlers、orm、orm.sql ...)，
+级别在config_default.configs['logging']['levels']中分别设置。
+日志参数一律延迟格式化: logger.info('SQL: %s', sql)，级别不够时不会生成字符串；
+需要序列化等额外开销的参数先用logger.isEnabledFor判断。
+'''
+
+import logging
+
+def init_logging(level='INFO', format=None, levels=None):
+	'''
+	初始化日志
+	:level:根logger的级别
+	:format:日志格式，缺省使用logging.BASIC_FORMAT
+	:levels:子系统logger名 => 级别
+	:return:无
+	'''
+	logging.basicConfig(level=level, format=format or logging.BASIC_FORMAT)
+	logging.getLogger().setLevel(level)
+	for name, lv in (levels or {}).items():
+		logging.getLogger(name).setLevel(lv)
@@ -0,0 +1,67 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+Markdown渲染缓存
+博客内容按sha1缓存渲染后的HTML，较大的内容在进程池中渲染，避免阻塞事件循环
+'''
+
+import asyncio, hashlib, logging
+from concurrent.futures import ProcessPoolExecutor
+
+import markdown2
+
+from config import configs
+from cache import LRUCache
+
+logger = logging.getLogger('markdowns')
+
+# sha1(内容) => HTML
+_html_cache = LRUCache(configs.markdown.cache_size)
+_executor = None
+
+def _content_key(text):
+	return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def _get_executor():
+	'''
+	延迟创建渲染进程池
+	:return:ProcessPoolExecutor
+	'''
+	global _executor
+	if _executor is None:
+		logger.info('create markdown process pool, workers: %s', configs.markdown.workers)
+		_executor = ProcessPoolExecutor(max_workers=configs.markdown.workers)
+	return _executor
+
+async def markdown2html(text):
+	'''
+	将markdown文本渲染为HTML，结果按内容缓存
+	:text:markdown文本
+	:return:HTML
+	'''
+	if not text:
+		return ''
+	key = _content_key(text)
+	html = _html_cache.get(key)
+	if html is not None:
+		return html
+	if configs.markdown.workers > 0 and len(text) >= configs.markdown.offload_size:
+		# 进程间传递文本有开销，只有较大的内容才交给进程池
+		loop = asyncio.get_event_loop()
+		html = await loop.run_in_executor(_get_executor(), markdown2.markdown, text)
+	else:
+		html = markdown2.markdown(text)
+	_html_cache.set(key, html)
+	return html
+
+def shutdown():
+	'''
+	关闭渲染进程池
+	:return:无
+	'''
+	global _executor
+	if _executor is not None:
+		_executor.shutdown(wait=False)
+		_executor = None
@@ -0,0 +1,147 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+进程内的运行指标，按Prometheus文本格式(text/plain; version=0.0.4)输出
+指标在模块导入时定义，记录时只是字典查找和加法，不做任何I/O
+'''
+
+import math
+
+# 所有已定义的指标，按定义顺序输出
+_registry = []
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra=None):
+	pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+	if extra:
+		pairs.append(extra)
+	return '{%s}' % ','.join(pairs) if pairs else ''
+
+def _number(value):
+	if value == math.inf:
+		return '+Inf'
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric(object):
+	'''
+	指标基类
+	:name:指标名
+	:help:说明
+	:labelnames:标签名列表，记录时按相同顺序传入标签值
+	'''
+	type = None
+
+	def __init__(self, name, help, labelnames=()):
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labelnames)
+		_registry.append(self)
+
+	def samples(self):
+		'''
+		:return:[(指标名后缀, 标签值tuple, 附加标签, 值), ...]
+		'''
+		raise NotImplementedError
+
+	def render(self):
+		lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+		for suffix, values, extra, value in self.samples():
+			lines.append('%s%s%s %s' % (self.name, suffix, _labels(self.labelnames, values, extra), _number(value)))
+		return '\n'.join(lines)
+
+class Counter(_Metric):
+	'''
+	只增不减的计数器
+	:fn:无参数的函数，返回{标签值tuple: 值}，用于输出其他对象自己维护的计数，存在时忽略inc的值
+	'''
+	type = 'counter'
+
+	def __init__(self, name, help, labelnames=(), fn=None):
+		super().__init__(name, help, labelnames)
+		self._values = {}
+		self._fn = fn
+
+	def inc(self, labels=(), amount=1):
+		self._values[labels] = self._values.get(labels, 0) + amount
+
+	def get(self, labels=()):
+		return self._values.get(labels, 0)
+
+	def samples(self):
+		values = self._fn() if self._fn is not None else self._values
+		return [('', k, None, v) for k, v in values.items()]
+
+class Gauge(_Metric):
+	'''
+	当前值，可以直接设置，也可以在输出时由函数计算
+	:fn:无参数的函数，返回{标签值tuple: 值}，存在时忽略set/inc的值
+	'''
+	type = 'gauge'
+
+	def __init__(self, name, help, labelnames=(), fn=None):
+		super().__init__(name, help, labelnames)
+		self._values = {}
+		self._fn = fn
+
+	def set(self, labels=(), value=0):
+		self._values[labels] = value
+
+	def inc(self, labels=(), amount=1):
+		self._values[labels] = self._values.get(labels, 0) + amount
+
+	def dec(self, labels=(), amount=1):
+		self.inc(labels, -amount)
+
+	def samples(self):
+		values = self._fn() if self._fn is not None else self._values
+		return [('', k, None, v) for k, v in values.items()]
+
+class Histogram(_Metric):
+	'''
+	分布统计
+	:buckets:递增的桶上限，自动追加+Inf
+	'''
+	type = 'histogram'
+
+	def __init__(self, name, help, labelnames=(), buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)):
+		super().__init__(name, help, labelnames)
+		self.buckets = tuple(buckets) + (math.inf,)
+		# 标签值tuple => [各桶计数(非累计), 总和, 次数]
+		self._values = {}
+
+	def observe(self, labels=(), value=0):
+		item = self._values.get(labels)
+		if item is None:
+			item = self._values[labels] = [[0] * len(self.buckets), 0, 0]
+		for i, bound in enumerate(self.buckets):
+			if value <= bound:
+				item[0][i] += 1
+				break
+		item[1] += value
+		item[2] += 1
+
+	def count(self, labels=()):
+		item = self._values.get(labels)
+		return item[2] if item is not None else 0
+
+	def samples(self):
+		rs = []
+		for labels, (counts, total, count) in self._values.items():
+			acc = 0
+			for bound, n in zip(self.buckets, counts):
+				acc += n
+				rs.append(('_bucket', labels, 'le="%s"' % _number(bound), acc))
+			rs.append(('_sum', labels, None, total))
+			rs.append(('_count', labels, None, count))
+		return rs
+
+def render():
+	'''
+	输出所有指标
+	:return:Prometheus文本格式的字符串
+	'''
+	return '\n'.join(m.render() for m in _registry) + '\n'
@@ -3,7 +3,9 @@
 __author__ = "Sunshine'Z"
 
 import  time, uuid
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, on_commit
+from cache import invalidate_user_sessions
+from markdowns import markdown2html
 
 def next_id():
 	'''
@@ -23,23 +25,69 @@ class User(Model):
 	image = StringField(ddl = 'VARCHAR(500)')
 	created_at = FloatField(default = time.time)
 
+	async def update(self):
+		# passwd或者admin可能发生变化，已缓存的会话必须在提交后重新验证
+		await super().update()
+		uid = self.id
+		on_commit(lambda: invalidate_user_sessions(uid))
+
+	async def remove(self):
+		await super().remove()
+		uid = self.id
+		on_commit(lambda: invalidate_user_sessions(uid))
+
+	@classmethod
+	async def updateMany(cls, objs, chunk=None):
+		objs = list(objs)
+		rows = await super().updateMany(objs, chunk)
+		uids = [user.id for user in objs]
+		on_commit(lambda: [invalidate_user_sessions(uid) for uid in uids])
+		return rows
+
 class Blog(Model):
 	__table__ = 'blogs'
 
 	id = StringField(primary_key = True, default = next_id, ddl = 'VARCHAR(50)')
-	user_id = StringField(ddl='VARCHAR(50)')
+	user_id = StringField(ddl='VARCHAR(50)', ref = 'User')
 	user_name = StringField(ddl='VARCHAR(50)')
 	user_image = StringField(ddl='varchar(500)')
 	name = StringField(ddl='varchar(50)')
 	summary = StringField(ddl='varchar(200)')
-	content = TextField()
+	# 列表页不需要正文，findAll缺省不查询
+	content = TextField(deferred = True)
 	created_at = FloatField(default=time.time)
 
+	async def save(self):
+		# 写入时预先渲染内容，查看博客时直接使用缓存的HTML
+		await markdown2html(self.content)
+		await super().save()
+
+	async def update(self):
+		if 'content' in self:
+			await markdown2html(self.content)
+		await super().update()
+
+	@classmethod
+	async def saveMany(cls, objs, chunk=None):
+		objs = list(objs)
+		for blog in objs:
+			await markdown2html(blog.content)
+		return await super().saveMany(objs, chunk)
+
+	@classmethod
+	async def updateMany(cls, objs, chunk=None):
+		objs = list(objs)
+		for blog in objs:
+			if 'content' in blog:
+				await markdown2html(blog.content)
+		return await super().updateMany(objs, chunk)
+
 class Comment(Model):
 	__table__ = 'comments'
 
 	id = StringField(primary_key=True, default = next_id, ddl = 'VARCHAR(50)')
-	blog_id = StringField(ddl = 'VARCHAR(50)')
+	blog_id = StringField(ddl = 'VARCHAR(50)', ref = 'Blog')
+	user_id = StringField(ddl = 'VARCHAR(50)', ref = 'User')
 	user_name = StringField(ddl = 'VARCHAR(50)')
 	user_image = StringField(ddl = 'VARCHAR(50)')
 	content = TextField()
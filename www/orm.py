@@ -2,83 +2,479 @@
 
 __author__ = "Sunshine'Z"
 
-import asyncio, logging
-import aiomysql
+import asyncio, contextvars, functools, logging, re, time
 import  json
 
-logging.basicConfig(level=logging.INFO)
+import backends, metrics, timing
+
+logger = logging.getLogger('orm')
+# SQL语句和返回行数单独使用一个logger，可以只关闭这部分日志
+_sql_logger = logging.getLogger('orm.sql')
+
+# 每个Model的总行数缓存: Model => (行数, 读取时间)，由save/remove维护
+_row_counts = {}
+# 行数缓存的有效期(秒)，用于修正其他进程写入造成的偏差
+_count_ttl = 60
+# saveMany/updateMany每条语句包含的最大记录数
+_batch_size = 500
+# 存储后端，见backends
+_backend = backends.get_backend('mysql')
+
+def set_backend(name):
+	'''
+	切换存储后端，必须在create_pool之前调用(create_pool会根据参数backend调用)
+	:param name:后端名，mysql或者sqlite
+	:return:无
+	'''
+	global _backend
+	if _backend.name == name:
+		return
+	logger.info('set database backend: %s', name)
+	_backend = backends.get_backend(name)
+	# 缓存的语句可能是按之前的后端转换的
+	for fn in (_translate, _findall_sql, _number_sql, _select_sql, _find_sql, _findmany_sql, _update_sql):
+		fn.cache_clear()
+
+@functools.lru_cache(maxsize=1024)
+def _translate(sql):
+	'''
+	将sql语句中的'?'替换成驱动使用的格式(mysql为'%s')，结果按语句缓存
+	Model生成的语句在类创建或者第一次使用时就固定下来，之后每次查询只是一次缓存查找
+	:param sql:sql语句
+	:return:驱动格式的sql语句
+	'''
+	return _backend.translate(sql)
 
 def log(sql, args=()):
-	logging.info('SQL: %s, ARGS: %s' % (sql, args))
+	_sql_logger.info('SQL: %s, ARGS: %s', sql, args)
+
+_RE_VALUES = re.compile(r'\(\?(?:, ?\?)*\)(?:, ?\(\?(?:, ?\?)*\))+')
+_RE_IN = re.compile(r'IN \(\?(?:, ?\?)*\)')
+_RE_WHEN = re.compile(r'(?:WHEN \? THEN \? ?)+')
+
+@functools.lru_cache(maxsize=1024)
+def _shape(sql):
+	'''
+	语句的形状，用作指标的标签
+	saveMany/updateMany以及IN (...)的语句随记录数变化，这里把重复的部分合并成一个，避免标签数量无限增长
+	:param sql:sql语句
+	:return:合并后的sql语句
+	'''
+	sql = _RE_VALUES.sub('(...), ...', sql)
+	sql = _RE_IN.sub('IN (...)', sql)
+	return _RE_WHEN.sub('WHEN ? THEN ? ... ', sql)
+
+# 连接池 => 指标中的名字(primary、replica0、replica1 ...)
+_pool_names = {}
+
+def _pool_stats():
+	rs = {}
+	for pool, name in _pool_names.items():
+		rs[(name, 'in_use')], rs[(name, 'free')], rs[(name, 'max')] = _backend.pool_stats(pool)
+	return rs
+
+_pool_connections = metrics.Gauge('orm_pool_connections', 'Connections of each pool by state.', ('pool', 'state'), fn=_pool_stats)
+_pool_waiting = metrics.Gauge('orm_pool_waiting', 'Coroutines waiting for a connection.', ('pool',))
+_pool_checkout = metrics.Histogram('orm_pool_checkout_seconds', 'Time spent waiting for a connection.', ('pool',),
+	buckets=(.0005, .001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+_query_seconds = metrics.Histogram('orm_query_seconds', 'Statement latency by shape.', ('shape',))
+_select_coalesced = metrics.Counter('orm_select_coalesced_total', 'Selects that waited for an identical in-flight select.')
+_query_rows = metrics.Histogram('orm_query_rows', 'Rows returned by select or affected by execute, by shape.', ('shape',),
+	buckets=(0, 1, 10, 100, 1000, 10000))
+
+def _observe(sql, start, rows):
+	seconds = time.perf_counter() - start
+	shape = (_shape(sql),)
+	_query_seconds.observe(shape, seconds)
+	_query_rows.observe(shape, rows)
+	timing.record_query(sql, seconds)
+
+# 只读副本的连接池，select优先使用；execute和事务总是使用主库__pool
+_replicas = []
+# 选择副本的策略: round_robin - 轮流使用，least_busy - 使用中的连接占比最小的副本
+_replica_policy = 'round_robin'
+_replica_next = 0
+# 写入之后，同一个请求(任务)中的查询是否改为读主库
+_read_your_writes = True
+# 为True时当前任务的查询读主库
+_read_primary = contextvars.ContextVar('orm_read_primary', default=False)
+# 当前请求是否已经执行过写入，由identity_scope()限定在一个请求内；
+# 不在identity_scope()中时，写入之后当前任务以及从它创建的任务都一直读主库、不合并查询，脚本应该自己打开identity_scope()
+_wrote = contextvars.ContextVar('orm_wrote', default=False)
+# 是否合并并发执行的相同查询
+_single_flight = True
+# 正在执行的查询: (sql, args, size, 是否读主库) => Task
+_inflight = {}
+# 当前请求的identity map: (Model, 主键) => Model对象，不在identity_scope()中时为None
+_identity_map = contextvars.ContextVar('orm_identity_map', default=None)
 
 async def create_pool(loop, **kw):
 	'''
 	创建数据库连接池
 	:param loop:事件循环处理程序
 	:param kw:数据库配置参数集合
+		backend - 存储后端，mysql(缺省)或者sqlite，sqlite使用参数path(缺省为内存数据库)
+		replicas - 只读副本的配置列表，每一项覆盖主库的host、port等参数；
+			sqlite后端的副本是各自独立的数据库(每一项指定path)，没有复制，只用于验证读写路由
+		replica_policy - 选择副本的策略，round_robin或者least_busy
+		read_your_writes - 写入之后同一个请求中的查询是否改为读主库
+		single_flight - 是否合并并发执行的相同查询
 	:return:无
 	缺省情况下将编码设置为utf8，自动提交事务
 	'''
-	logging.info('create database connection pool...')
-	global __pool
-	__pool = await aiomysql.create_pool(
-		host = kw.get('host', 'localhost'),
-		port = kw.get('port', 3306),
-		user = kw['user'],
-		password = kw['password'],
-		db = kw['db'],
-		charset = kw.get('charset', 'utf8'),
-		autocommit = kw.get('autocommit', True),
-		maxsize = kw.get('maxsize', 10),
-		minsize  = kw.get('minsize', 1),
-		loop = loop
-	)
+	logger.info('create database connection pool...')
+	global __pool, _count_ttl, _batch_size, _replicas, _replica_policy, _read_your_writes, _single_flight
+	_count_ttl = kw.get('count_ttl', _count_ttl)
+	_single_flight = kw.get('single_flight', _single_flight)
+	_batch_size = kw.get('batch_size', _batch_size)
+	_replica_policy = kw.get('replica_policy', _replica_policy)
+	_read_your_writes = kw.get('read_your_writes', _read_your_writes)
+	set_backend(kw.get('backend', 'mysql'))
+	__pool = await _backend.create_pool(loop, kw)
+	_replicas = []
+	_pool_names.clear()
+	_pool_names[__pool] = 'primary'
+	replicas = kw.get('replicas') or ()
+	if replicas and not _backend.replicas:
+		logger.warning('replicas are not supported by the %s backend, ignored', _backend.name)
+		replicas = ()
+	for replica in replicas:
+		options = dict(kw)
+		options.update(replica)
+		logger.info('create replica connection pool: %s', _backend.describe(options))
+		pool = await _backend.create_pool(loop, options)
+		_pool_names[pool] = 'replica%s' % len(_replicas)
+		_replicas.append(pool)
+
+async def close_pool():
+	'''
+	关闭主库和副本的连接池，等待连接全部关闭
+	:return:无
+	'''
+	global _replicas
+	pools = list(_pool_names)
+	_pool_names.clear()
+	_replicas = []
+	for pool in pools:
+		await _backend.close_pool(pool)
+
+async def create_tables(*models):
+	'''
+	按Model的__mappings__建表(CREATE TABLE IF NOT EXISTS)，用于sqlite后端或者新的数据库
+	sqlite后端的副本是独立的数据库，同时在副本上建表；mysql的副本通过复制得到表结构
+	:param models:Model类，缺省为所有的Model
+	:return:无
+	'''
+	for model in models or list(_models.values()):
+		sql = _backend.create_table_sql(model)
+		await execute(sql, ())
+		if _backend.name == 'sqlite':
+			for pool in _replicas:
+				async with _checkout(pool) as conn:
+					await _execute(conn, sql, ())
+
+async def _acquire(pool):
+	'''
+	从连接池取得连接，记录等待的协程数和等待时间
+	:param pool:连接池
+	:return:连接
+	'''
+	labels = (_pool_names.get(pool, 'primary'),)
+	_pool_waiting.inc(labels)
+	start = time.perf_counter()
+	try:
+		return await _backend.acquire(pool)
+	finally:
+		_pool_waiting.dec(labels)
+		_pool_checkout.observe(labels, time.perf_counter() - start)
+
+class _checkout(object):
+	'''
+	async with _checkout(pool) as conn:
+	与pool.get()相同，另外记录取得连接的等待时间
+	'''
+	def __init__(self, pool):
+		self.pool = pool
+		self.conn = None
+
+	async def __aenter__(self):
+		self.conn = await _acquire(self.pool)
+		return self.conn
+
+	async def __aexit__(self, exc_type, exc, tb):
+		conn, self.conn = self.conn, None
+		await _backend.release(self.pool, conn)
+		return False
+
+def _read_pool():
+	'''
+	选择查询使用的连接池
+	:return:副本的连接池，没有副本或者需要读主库时返回主库的连接池
+	'''
+	global _replica_next
+	if not _replicas or _reads_primary():
+		return __pool
+	if _replica_policy == 'least_busy':
+		return min(_replicas, key=_busy)
+	_replica_next = (_replica_next + 1) % len(_replicas)
+	return _replicas[_replica_next]
+
+def _busy(pool):
+	# 使用中的连接占比
+	in_use, free, maxsize = _backend.pool_stats(pool)
+	return in_use / maxsize
+
+def _reads_primary():
+	return _read_primary.get() or (_read_your_writes and _wrote.get())
+
+class use_primary(object):
+	'''
+	块内的查询读主库，用于必须读到最新数据的场合
+	with orm.use_primary():
+		user = await User.find(uid)
+	'''
+	def __enter__(self):
+		self._token = _read_primary.set(True)
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		_read_primary.reset(self._token)
+		return False
+
+	async def __aenter__(self):
+		return self.__enter__()
+
+	async def __aexit__(self, exc_type, exc, tb):
+		return self.__exit__(exc_type, exc, tb)
+
+# 当前任务所在的事务
+_current_transaction = contextvars.ContextVar('orm_transaction', default=None)
+
+def _get_pool():
+	# 类定义中的__pool会被改写成_类名__pool，类中通过该函数访问连接池
+	return __pool
+
+class identity_scope(object):
+	'''
+	with orm.identity_scope():
+		...
+	块内Model.find(pk)查询过的记录按(Model, 主键)保存，再次查询同一条记录时直接返回同一个对象，
+	执行任何写入之后清空。每个请求使用一个，由app中的identity_factory中间件创建；
+	同时也是"本请求已经写入"(读主库、不合并查询)的范围: 进入时清除，退出时恢复，块外之前的写入不影响块内的查询
+	'''
+	def __enter__(self):
+		self._token = _identity_map.set({})
+		self._wrote_token = _wrote.set(False)
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		_wrote.reset(self._wrote_token)
+		_identity_map.reset(self._token)
+		return False
+
+class transaction(object):
+	'''
+	事务上下文
+	async with orm.transaction():
+		...
+	块内的select/execute以及Model的方法共用同一个连接，正常退出时提交一次，出现异常时回滚。
+	嵌套使用时内层直接加入外层事务，只有最外层提交。块内不要并发执行查询，语句会在该连接上排队执行。
+	'''
+	def __init__(self):
+		self.conn = None
+		self._outer = None
+		self._token = None
+		self._lock = None
+		self._on_commit = []
+
+	async def __aenter__(self):
+		self._outer = _current_transaction.get()
+		if self._outer is not None:
+			return self._outer
+		self.conn = await _acquire(_get_pool())
+		self._lock = asyncio.Lock()
+		try:
+			await _backend.begin(self.conn)
+		except BaseException as e:
+			await _backend.release(_get_pool(), self.conn)
+			raise
+		self._token = _current_transaction.set(self)
+		return self
+
+	async def __aexit__(self, exc_type, exc, tb):
+		if self._outer is not None:
+			return False
+		_current_transaction.reset(self._token)
+		try:
+			if exc_type is None:
+				await _backend.commit(self.conn)
+			else:
+				await _backend.rollback(self.conn)
+		finally:
+			await _backend.release(_get_pool(), self.conn)
+			self.conn = None
+		if exc_type is None:
+			_detach_inflight()
+			for fn in self._on_commit:
+				fn()
+		return False
+
+def on_commit(fn):
+	'''
+	在当前事务提交后调用fn，不在事务中时立即调用
+	:param fn:无参数的函数
+	:return:无
+	'''
+	tx = _current_transaction.get()
+	if tx is None:
+		fn()
+	else:
+		tx._on_commit.append(fn)
+
+async def _select(conn, sql, args, size):
+	# 创建一个结果为字典的游标
+	start = time.perf_counter()
+	# 执行sql语句，将sql语句中的'?'替换成驱动的格式
+	rs = await _backend.select(conn, _translate(sql), args, size)
+	_observe(sql, start, len(rs))
+	_sql_logger.info('rows returned: %s', len(rs))
+	return rs
 
 async def select(sql, args, size=None):
 	'''
-	数据库查询函数
+	数据库查询函数，在transaction()中时使用事务的连接，否则优先使用只读副本
 	:param sql:sql语句
 	:param args:sql语句中的参数
 	:param size:要查询的数量
 	:return:查询结果
 	'''
 	log(sql, args)
-	async with __pool.get() as conn:
-		# 创建一个结果为字典的游标
-		async with conn.cursor(aiomysql.DictCursor) as cur:
-			# 执行sql语句，将sql语句中的'?'替换成'%s'
-			await cur.execute(sql.replace('?', '%s'), args or ())
-			# 如果指定了数量，就返回指定数量的记录，如果没有就返回所有记录
-			if size:
-				rs = await cur.fetchmany(size)
-			else:
-				rs = await cur.fetchall()
-		logging.info('rows returned: %s' % len(rs))
-		return rs
+	tx = _current_transaction.get()
+	if tx is not None:
+		async with tx._lock:
+			return await _select(tx.conn, sql, args, size)
+	# 本请求写入之后的查询不与其他请求合并，合并的查询可能在写入之前就开始执行了
+	if not _single_flight or _wrote.get():
+		return await _pool_select(sql, args, size)
+	key = (sql, tuple(args) if args else (), size, _reads_primary())
+	try:
+		task = _inflight.get(key)
+	except TypeError:
+		# 参数不能作为字典的键
+		return await _pool_select(sql, args, size)
+	if task is not None:
+		# 相同的查询正在执行，等待它的结果；每条记录复制一份，调用方可以随意修改
+		_select_coalesced.inc()
+		rs = await asyncio.shield(task)
+		return [dict(r) for r in rs]
+	# 查询在单独的任务中执行，发起者被取消时其他等待者仍然可以得到结果
+	task = asyncio.ensure_future(_pool_select(sql, args, size))
+	_inflight[key] = task
+	task.add_done_callback(lambda t: _select_done(key, t))
+	return await asyncio.shield(task)
+
+def _select_done(key, task):
+	# 写入之后key可能已经对应新的查询
+	if _inflight.get(key) is task:
+		del _inflight[key]
+	# 所有等待者都被取消时，避免asyncio报告异常没有被读取
+	if not task.cancelled():
+		task.exception()
+
+def _detach_inflight():
+	'''
+	写入提交之后调用: 正在执行的查询可能开始于写入之前，之后的查询不再与它们合并，已经在等待的调用方仍然得到它们的结果
+	'''
+	_inflight.clear()
+
+async def _pool_select(sql, args, size):
+	async with _checkout(_read_pool()) as conn:
+		return await _select(conn, sql, args, size)
+
+async def select_iter(sql, args, batch=100):
+	'''
+	使用服务端游标(mysql后端为aiomysql.SSDictCursor)逐批读取查询结果，内存中最多只有一批记录
+	迭代结束之前一直占用一个连接；在transaction()中或者后端不支持服务端游标时先读取全部结果再分批返回
+	:param sql:sql语句
+	:param args:sql语句中的参数
+	:param batch:每批的记录数
+	:return:异步生成器，每次产生一批记录(list)
+	'''
+	log(sql, args)
+	tx = _current_transaction.get()
+	if tx is not None or not _backend.streaming:
+		if tx is not None:
+			async with tx._lock:
+				rs = await _select(tx.conn, sql, args, None)
+		else:
+			rs = await _pool_select(sql, args, None)
+		for i in range(0, len(rs), batch):
+			yield rs[i:i + batch]
+		return
+	async with _checkout(_read_pool()) as conn:
+		batches = _backend.iterate(conn, _translate(sql), args, batch)
+		try:
+			# 只统计执行到第一批记录返回的时间，不包括调用方处理每批记录的时间
+			start = time.perf_counter()
+			seconds = None
+			rows = 0
+			async for rs in batches:
+				if seconds is None:
+					seconds = time.perf_counter() - start
+				rows += len(rs)
+				yield rs
+			if seconds is None:
+				seconds = time.perf_counter() - start
+			_query_seconds.observe((_shape(sql),), seconds)
+			_query_rows.observe((_shape(sql),), rows)
+			timing.record_query(sql, seconds)
+		finally:
+			# 提前结束迭代时立即关闭游标，再归还连接
+			await batches.aclose()
+
+async def _execute(conn, sql, args):
+	start = time.perf_counter()
+	rows = await _backend.execute(conn, _translate(sql), args)
+	_observe(sql, start, rows)
+	return rows
 
 async def execute(sql, args, autocommit=True):
 	'''
-	数据库DML
+	数据库DML，总是使用主库；在transaction()中时使用事务的连接，由事务统一提交
 	:param sql:sql语句
 	:param args:sql语句中的参数
 	:param autocommit:是否自动提交事务
 	:return:返回操作的结果数
 	'''
 	log(sql, args)
-	async with __pool.get() as conn:
-		if not autocommit:
-			await conn.begin()
-		try:
-			async with conn.cursor(aiomysql.DictCursor) as cur:
-				await cur.execute(sql.replace('?', '%s'), args)
-				affected = cur.rowcount
-			if not autocommit:
-				await conn.commit()
-		except BaseException as e:
-			if not autocommit:
-				await conn.rollback()
-			raise
-		return affected
+	# 当前请求之后的查询读主库(避免副本延迟导致读不到刚写入的数据)，并且不再与其他请求合并
+	_wrote.set(True)
+	identities = _identity_map.get()
+	if identities:
+		identities.clear()
+	tx = _current_transaction.get()
+	if tx is not None:
+		async with tx._lock:
+			return await _execute(tx.conn, sql, args)
+	if not autocommit:
+		async with transaction():
+			return await execute(sql, args)
+	async with _checkout(__pool) as conn:
+		rows = await _execute(conn, sql, args)
+	_detach_inflight()
+	return rows
+
+async def execute_batch(statements):
+	'''
+	在同一个连接的同一个事务中执行多条DML
+	:param statements:[(sql语句, sql语句中的参数), ...]
+	:return:每条语句影响的行数列表
+	'''
+	counts = []
+	async with transaction():
+		for sql, args in statements:
+			counts.append(await execute(sql, args))
+	return counts
 
 def create_args_string(num):
 	'''
@@ -94,12 +490,14 @@ def create_args_string(num):
 class Field(object):
 	'''
 	定义Field类，负责保存(数据库)表的字段名和字段类型等信息
+	deferred为True的字段在findAll中缺省不查询，需要时使用columns参数或者await obj.load()读取
 	'''
-	def __init__(self, name, column_type, primary_key, default):
+	def __init__(self, name, column_type, primary_key, default, deferred=False):
 		self.name = name
 		self.column_type = column_type
 		self.primary_key = primary_key
 		self.default = default
+		self.deferred = deferred
 
 	def __str__(self):
 		return '<%s, %s, %s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -107,9 +505,12 @@ class Field(object):
 class StringField(Field):
 	'''
 	数据库中字符串类型
+	ref为引用的Model类名，例如blog_id = StringField(ref='Blog')，
+	去掉_id后的名字(blog)可以用于findAll(prefetch=['blog'])
 	'''
-	def __init__(self, name=None, primary_key=False, default=None, ddl='VARCHAR(100)'):
-		super().__init__(name, ddl, primary_key, default)
+	def __init__(self, name=None, primary_key=False, default=None, ddl='VARCHAR(100)', deferred=False, ref=None):
+		super().__init__(name, ddl, primary_key, default, deferred)
+		self.ref = ref
 
 class BooleanField(Field):
 	'''
@@ -136,8 +537,172 @@ class TextField(Field):
 	'''
 	数据库文本类型
 	'''
-	def __init__(self, name=None, default=0.0, ddl='TEXT'):
-		super().__init__(name, ddl, False, default)
+	def __init__(self, name=None, default=0.0, ddl='TEXT', deferred=False):
+		super().__init__(name, ddl, False, default, deferred)
+
+@functools.lru_cache(maxsize=256)
+def _select_sql(cls, columns):
+	'''
+	生成只查询指定列的SELECT语句，按(Model, columns)缓存
+	:param cls:Model类
+	:param columns:None - 除deferred字段以外的所有列，'*' - 所有列，tuple - 指定的列(总是包含主键)
+	:return:sql语句，以空格结尾，与__select__相同
+	'''
+	if columns == '*' or (columns is None and not cls.__deferred__):
+		return cls.__select__
+	if columns is None:
+		columns = [f for f in cls.__fields__ if f not in cls.__deferred__]
+	for f in columns:
+		if f not in cls.__mappings__:
+			raise ValueError('Invalid column for %s: %s' % (cls.__name__, f))
+	fields = [f for f in columns if f != cls.__primary_key__]
+	return 'SELECT %s FROM `%s` ' % (', '.join('`%s`' % f for f in [cls.__primary_key__] + fields), cls.__table__)
+
+@functools.lru_cache(maxsize=256)
+def _find_sql(cls, columns):
+	'''
+	生成按主键查询指定列的语句
+	'''
+	return '%sWHERE `%s` = ?' % (_select_sql(cls, columns), cls.__primary_key__)
+
+@functools.lru_cache(maxsize=256)
+def _findmany_sql(cls, num, columns):
+	'''
+	生成按多个主键查询的语句: WHERE `pk` IN (?, ...)
+	'''
+	return '%sWHERE `%s` IN (%s)' % (_select_sql(cls, columns), cls.__primary_key__, create_args_string(num))
+
+@functools.lru_cache(maxsize=256)
+def _update_sql(cls, fields):
+	'''
+	生成只更新指定字段的UPDATE语句，用于没有加载全部字段的对象
+	'''
+	return 'UPDATE `%s` SET %s WHERE `%s` = ?' % (cls.__table__, \
+		', '.join(map(lambda f: '`%s` = ?' % (cls.__mappings__[f].name or f), fields)), cls.__primary_key__)
+
+@functools.lru_cache(maxsize=256)
+def _keyset_order(cls, orderBy):
+	'''
+	keyset分页的排序: 排序字段相同的记录再按主键排序，保证游标(排序字段值, 主键值)之后的记录顺序确定
+	:param cls:Model类
+	:param orderBy:单个字段的排序，例如'created_at DESC'
+	:return:(排序字段, 比较运算符, 排序语句)
+	'''
+	order = orderBy.split() if orderBy else ()
+	if len(order) not in (1, 2) or (len(order) == 2 and order[1].upper() not in ('ASC', 'DESC')):
+		raise ValueError('Invalid orderBy value for keyset pagination: %s' % orderBy)
+	field = order[0]
+	op, direction = ('<', 'DESC') if len(order) == 2 and order[1].upper() == 'DESC' else ('>', 'ASC')
+	return field, op, '%s %s, `%s` %s' % (field, direction, cls.__primary_key__, direction)
+
+@functools.lru_cache(maxsize=256)
+def _findall_sql(cls, where, orderBy, limitShape, seek, columns=None):
+	'''
+	生成findAll的sql语句，按(Model, where, orderBy, limit形式, 是否keyset分页, 查询的列)缓存
+	:param cls:Model类
+	:param where:where查询条件
+	:param orderBy:排序
+	:param limitShape:0 - 没有limit，1 - LIMIT ?，2 - LIMIT ?, ?
+	:param seek:是否keyset分页
+	:param columns:查询的列，见_select_sql
+	:return:sql语句
+	'''
+	sql = [_select_sql(cls, columns)]
+	if seek:
+		# 按(排序字段, 主键)定位，代替LIMIT offset，深分页不再需要扫描offset行
+		if limitShape == 2:
+			raise ValueError('Invalid limit value for keyset pagination: offset is not allowed')
+		field, op, orderBy = _keyset_order(cls, orderBy)
+		cond = '(%s %s ? OR (%s = ? AND `%s` %s ?))' % (field, op, field, cls.__primary_key__, op)
+		where = '(%s) AND %s' % (where, cond) if where else cond
+	if where:
+		sql.append('WHERE ')
+		sql.append(where)
+	if orderBy:
+		sql.append(' ORDER BY ')
+		sql.append(orderBy)
+	if limitShape == 1:
+		sql.append(' LIMIT ?')
+	elif limitShape == 2:
+		sql.append(' LIMIT ?, ?')
+	return ''.join(sql)
+
+@functools.lru_cache(maxsize=256)
+def _number_sql(cls, selectField, where):
+	'''
+	生成findNumber的sql语句，按(Model, selectField, where)缓存
+	'''
+	sql = ['SELECT %s AS _num_ FROM `%s`' % (selectField, cls.__table__)]
+	if where:
+		sql.append('where')
+		sql.append(where)
+	return ' '.join(sql)
+
+def _columns(columns):
+	# findAll/find的columns参数转换为_select_sql可以缓存的形式
+	if columns is None or columns == '*':
+		return columns
+	return tuple(columns)
+
+class Row(object):
+	'''
+	Model的紧凑表示，ModelMetaclass根据__mappings__为每个Model生成子类(例如BlogRow)。
+	每个字段是一个slot，没有实例字典；属性访问不经过__getattr__。
+	同时支持row['name']、keys()、items()，模板和序列化时与Model的用法相同。
+	用于只读的查询结果：Model.findAll(..., compact=True)，需要保存时先调用toModel()
+	'''
+	__slots__ = ()
+
+	def __init__(self, **kw):
+		for k, v in kw.items():
+			setattr(self, k, v)
+
+	def __getitem__(self, key):
+		try:
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+
+	def __setitem__(self, key, value):
+		setattr(self, key, value)
+
+	def __contains__(self, key):
+		return key in self.__slots__ and hasattr(self, key)
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.keys())
+
+	def get(self, key, default=None):
+		return getattr(self, key, default)
+
+	def keys(self):
+		return [k for k in self.__slots__ if hasattr(self, k)]
+
+	def items(self):
+		return [(k, getattr(self, k)) for k in self.__slots__ if hasattr(self, k)]
+
+	def toDict(self):
+		'''
+		转换为dict，字段顺序与__slots__一致
+		:return:dict
+		'''
+		return dict(self.items())
+
+	def toModel(self):
+		'''
+		转换为对应的Model对象
+		:return:Model
+		'''
+		return self.__model__(**self.toDict())
+
+	def __repr__(self):
+		return '%s(%s)' % (self.__class__.__name__, ', '.join(['%s=%r' % kv for kv in self.items()]))
+
+# 所有的Model: 类名 => Model类，用于解析StringField(ref=...)
+_models = {}
 
 class ModelMetaclass(type):
 	'''
@@ -153,16 +718,18 @@ class ModelMetaclass(type):
 		if name == 'Model':
 			return type.__new__(cls, name, bases, attrs)
 		tableName = attrs.get('__table__', None) or name
-		logging.info('found model: %s (table: %s)' % (name, tableName))
+		logger.info('found model: %s (table: %s)', name, tableName)
 		# 保存属性名和列的映射关系
 		mappings = dict()
 		# 保存非主键属性名
 		fields = []
+		# 保存延迟加载的属性名
+		deferred = []
 		# 保存主键
 		primaryKey = None
 		for k, v in attrs.items():
 			if isinstance(v, Field):
-				logging.info('found mappings: %s ==> %s' % (k, v))
+				logger.info('found mappings: %s ==> %s', k, v)
 				mappings[k] = v
 				if v.primary_key:
 					if primaryKey:
@@ -170,8 +737,13 @@ class ModelMetaclass(type):
 					primaryKey = k
 				else:
 					fields.append(k)
+					if v.deferred:
+						deferred.append(k)
 		if not primaryKey:
 			raise StandardError('primary key not found.')
+		# 关联: 名字 => 引用其他Model主键的字段，例如blog => blog_id
+		relations = dict((k[:-3] if k.endswith('_id') else k, k) for k, v in mappings.items() \
+			if getattr(v, 'ref', None))
 		# 清空attrs中属性名
 		# 从类属性中删除该Field属性，否则，容易造成运行时错误（实例的属性会遮盖类的同名属性）
 		for k in mappings.keys():
@@ -184,14 +756,35 @@ class ModelMetaclass(type):
 		attrs['__primary_key__'] = primaryKey
 		# 除去主键以外的属性名称
 		attrs['__fields__'] = fields
+		attrs['__deferred__'] = frozenset(deferred)
+		attrs['__relations__'] = relations
 		# 构造默认的SELECT, INSERT, UPDATE和DELETE语句
 		attrs['__select__'] = 'SELECT `%s`, %s FROM `%s` ' % (primaryKey, ','.join(escaped_fields), tableName)
 		attrs['__insert__'] = 'INSERT INTO `%s` (%s, `%s`) VALUES(%s)' % (tableName, ','.join(escaped_fields), primaryKey,\
 			create_args_string(len(escaped_fields) + 1))
+		# 多行INSERT: __insert_head__ + ','.join([__insert_row__] * n)
+		attrs['__insert_head__'] = 'INSERT INTO `%s` (%s, `%s`) VALUES' % (tableName, ','.join(escaped_fields), primaryKey)
+		attrs['__insert_row__'] = '(%s)' % create_args_string(len(escaped_fields) + 1)
 		attrs['__update__'] = 'UPDATE `%s` SET %s WHERE `%s` = ?' % (tableName, \
 			', '.join(map(lambda f: '`%s` = ?' % (mappings.get(f).name or f), fields)), primaryKey)
 		attrs['__delete__'] = 'DELETE FROM `%s` WHERE `%s` = ?' % (tableName, primaryKey)
-		return type.__new__(cls, name, bases, attrs)
+		attrs['__find__'] = '%sWHERE `%s` = ?' % (attrs['__select__'], primaryKey)
+		attrs['__count__'] = 'SELECT COUNT(*) AS _num_ FROM `%s`' % tableName
+		# 预先转换成驱动格式，放入_translate的缓存
+		for key in ('__find__', '__count__', '__insert__', '__update__', '__delete__'):
+			_translate(attrs[key])
+		# findNumber中可以使用行数缓存的统计字段
+		attrs['__count_fields__'] = frozenset(fn % f for fn in ('COUNT(%s)', 'count(%s)') \
+			for f in ('*', '1', primaryKey, '`%s`' % primaryKey))
+		model = type.__new__(cls, name, bases, attrs)
+		# 紧凑表示: 与查询的列顺序一致的__slots__
+		model.__row__ = type('%sRow' % name, (Row,), {
+			'__slots__': tuple([primaryKey] + fields),
+			'__model__': model,
+			'__mappings__': mappings
+		})
+		_models[name] = model
+		return model
 
 class Model(dict, metaclass=ModelMetaclass):
 	def __init__(self, **kw):
@@ -201,6 +794,9 @@ class Model(dict, metaclass=ModelMetaclass):
 		try:
 			return self[key]
 		except KeyError:
+			if key in self.__mappings__:
+				raise AttributeError(r"'%s' object has not loaded field '%s', use columns=... or await obj.load()" % \
+					(self.__class__.__name__, key))
 			raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
 	def __setattr__(self, key, value):
@@ -217,10 +813,22 @@ class Model(dict, metaclass=ModelMetaclass):
 			if field.default is not None:
 				# field.default如果可以调用就返回调用后的结果
 				value = field.default() if callable(field.default) else field.default
-				logging.debug('using default value for %s: %s' % (key, str(value)))
+				logger.debug('using default value for %s: %s', key, value)
 				setattr(self, key, value)
 		return value
 
+	@classmethod
+	def keyset(cls, orderBy):
+		'''
+		keyset分页的排序字段和排序语句，例如'created_at DESC' => ('created_at', 'created_at DESC, `id` DESC')
+		之后要用findAll(after=...)翻页的offset查询也必须使用该排序，否则排序字段相同的记录顺序不确定，翻页时会跳过记录；
+		游标(after)由本页最后一条记录的排序字段和主键组成
+		:param orderBy:单个字段的排序
+		:return:(排序字段, 排序语句)
+		'''
+		field, op, order = _keyset_order(cls, orderBy)
+		return field.strip('`'), order
+
 	@classmethod
 	async def findAll(cls, where=None, args=None, **kw):
 		'''
@@ -229,32 +837,124 @@ class Model(dict, metaclass=ModelMetaclass):
 		:param where:where查询条件
 		:param args:sql参数
 		:param kw:查询条件列表
+			orderBy - 排序
+			limit - 数量或者(offset, 数量)
+			after - keyset分页，(排序字段值, 主键值)，只返回排在该记录之后的记录，
+				orderBy必须是单个字段，limit必须是数量；第一页的offset查询使用keyset(orderBy)的排序语句
+			compact - 为True时返回__row__(__slots__)对象而不是Model，占用内存更少，属性访问更快
+			stream - 为True时使用服务端游标，返回逐条产生记录对象的异步迭代器
+			batch - stream时每次从服务端读取的记录数，缺省100
+			columns - 查询的列，缺省为deferred字段以外的所有列，'*'为所有列，主键总是包含在内；
+				没有查询的字段可以用await obj.load()读取，update()只写入已经加载的字段
+			prefetch - 同时读取的关联记录，例如Comment.findAll(prefetch=['blog'])，
+				每个关联一次查询，结果保存在comment.blog中，不能与compact、stream同时使用
 		:return:多条记录集合
 		'''
-		sql = [cls.__select__]
-		if where:
-			sql.append('WHERE ')
-			sql.append(where)
-		if args is None:
-			args = []
 		orderBy = kw.get('orderBy', None)
-		if orderBy:
-			sql.append('ORDER BY ')
-			sql.append(orderBy)
 		limit = kw.get('limit', None)
-		if limit is not None:
-			sql.append(' LIMIT ')
-			if isinstance(limit, int):
-				sql.append('?')
-				args.append(limit)
-			elif isinstance(limit, tuple) and len(limit) == 2:
-				sql.append('?, ?')
-				args.extend(limit)
+		after = kw.get('after', None)
+		if limit is None:
+			limitShape = 0
+		elif isinstance(limit, int):
+			limitShape = 1
+		elif isinstance(limit, tuple) and len(limit) == 2:
+			limitShape = 2
+		else:
+			raise ValueError('Invalid limit value: %s' % str(limit))
+		sql = _findall_sql(cls, where, orderBy, limitShape, after is not None, _columns(kw.get('columns')))
+		args = list(args) if args else []
+		if after is not None:
+			args.extend((after[0], after[0], after[1]))
+		if limitShape == 1:
+			args.append(limit)
+		elif limitShape == 2:
+			args.extend(limit)
+		make = cls.__row__ if kw.get('compact') else cls
+		prefetch = kw.get('prefetch')
+		if prefetch and (kw.get('compact') or kw.get('stream')):
+			raise ValueError('prefetch cannot be used with compact or stream')
+		if kw.get('stream'):
+			return cls._stream(make, sql, args, kw.get('batch', 100))
+		rs = await select(sql, args)
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug('findAll result: %s', json.dumps(rs))
+		objs = [make(**r) for r in rs]
+		if prefetch:
+			await cls.prefetch(objs, *prefetch)
+		return objs
+
+	@classmethod
+	async def findMany(cls, pks, chunk=None, columns=None):
+		'''
+		按多个主键查询记录，每chunk个主键一条WHERE `pk` IN (...)语句
+		:param pks:主键集合，重复的和None会被忽略
+		:param chunk:每条语句的最大主键数，缺省使用_batch_size
+		:param columns:查询的列，缺省为所有列，见findAll
+		:return:dict，主键 => 记录对象，不存在的主键不在结果中
+		'''
+		result = {}
+		identities = None
+		if columns is None and _current_transaction.get() is None:
+			identities = _identity_map.get()
+		todo = []
+		for pk in dict.fromkeys(pks):
+			if pk is None:
+				continue
+			obj = identities.get((cls, pk)) if identities is not None else None
+			if obj is not None:
+				result[pk] = obj
 			else:
-				raise ValueError('Invalid limit value: %s' % str(limit))
-		rs = await select(''.join(sql), args)
-		logging.debug('findAll result: %s' % json.dumps(rs))
-		return [cls(**r) for r in rs]
+				todo.append(pk)
+		columns = '*' if columns is None else _columns(columns)
+		chunk = chunk or _batch_size
+		for i in range(0, len(todo), chunk):
+			part = todo[i:i + chunk]
+			for r in await select(_findmany_sql(cls, len(part), columns), part):
+				obj = cls(**r)
+				result[obj.getValue(cls.__primary_key__)] = obj
+				if identities is not None:
+					identities[(cls, obj.getValue(cls.__primary_key__))] = obj
+		return result
+
+	@classmethod
+	async def prefetch(cls, objs, *names):
+		'''
+		读取记录集合的关联记录，每个关联只查询一次(按findMany分批)，避免逐条find
+		await Comment.prefetch(comments, 'blog', 'user')
+		:param objs:记录对象集合
+		:param names:关联名，见__relations__
+		:return:无，关联记录保存在obj[name]中，不存在时为None
+		'''
+		for name in names:
+			field = cls.__relations__.get(name)
+			if field is None:
+				raise ValueError('Invalid relation for %s: %s' % (cls.__name__, name))
+			model = _models[cls.__mappings__[field].ref]
+			related = await model.findMany(obj.get(field) for obj in objs)
+			for obj in objs:
+				obj[name] = related.get(obj.get(field))
+
+	@classmethod
+	async def iterAll(cls, where=None, args=None, batch=1000, **kw):
+		'''
+		使用服务端游标分批遍历记录，内存中最多只有一批记录对象，适合重建索引、预热缓存、导出等维护任务
+		async for blogs in Blog.iterAll(batch=500):
+			...
+		:param where:where查询条件
+		:param args:sql参数
+		:param batch:每批的记录数
+		:param kw:orderBy - 排序，columns - 查询的列，与findAll相同
+		:return:异步生成器，每次产生一批记录对象(list)
+		'''
+		sql = _findall_sql(cls, where, kw.get('orderBy', None), 0, False, _columns(kw.get('columns')))
+		async for rs in select_iter(sql, args, batch):
+			yield [cls(**r) for r in rs]
+
+	@classmethod
+	async def _stream(cls, make, sql, args, batch):
+		async for rs in select_iter(sql, args, batch):
+			for r in rs:
+				yield make(**r)
 
 	@classmethod
 	async def findNumber(cls, selectField, where=None, args=None):
@@ -265,44 +965,175 @@ class Model(dict, metaclass=ModelMetaclass):
 		:param args: 参数列表
 		:return: 数量
 		'''
-		sql = ['SELECT %s AS _num_ FROM `%s`' % (selectField, cls.__table__)]
-		if where:
-			sql.append('where')
-			sql.append(where)
-		rs = await select(' '.join(sql), args, 1)
+		if where is None and selectField in cls.__count_fields__:
+			return await cls.countAll()
+		rs = await select(_number_sql(cls, selectField, where), args, 1)
 		if len(rs) == 0:
 			return None
 		return rs[0]['_num_']
 
 	@classmethod
-	async def find(cls, pk):
+	async def countAll(cls):
+		'''
+		查询总行数，结果缓存在进程内，save/remove时同步更新，超过_count_ttl后重新查询
+		:return: 数量
+		'''
+		item = _row_counts.get(cls)
+		if item is not None and time.time() - item[1] < _count_ttl:
+			return item[0]
+		rs = await select(cls.__count__, None, 1)
+		num = rs[0]['_num_'] if rs else 0
+		_row_counts[cls] = (num, time.time())
+		return num
+
+	@classmethod
+	def _adjustCount(cls, delta):
+		'''
+		插入或者删除记录后更新行数缓存
+		:param delta: 行数变化
+		'''
+		def adjust():
+			item = _row_counts.get(cls)
+			if item is not None:
+				_row_counts[cls] = (max(item[0] + delta, 0), item[1])
+		# 在事务中时等提交之后再更新，回滚的写入不影响行数
+		on_commit(adjust)
+
+	@classmethod
+	def resetCount(cls):
+		'''
+		丢弃行数缓存，绕过ORM直接修改表之后调用
+		'''
+		_row_counts.pop(cls, None)
+
+	@classmethod
+	async def find(cls, pk, columns=None):
 		'''
 		通过查找记录对象
 		:param cls:自身类对象
 		:param pk:查询条件主键
+		:param columns:查询的列，缺省为所有列(包括deferred字段)
 		:return:
 		'''
-		rs = await select('%s where `%s` = ?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+		# 只有完整的记录放入identity map，事务中总是查询数据库
+		identities = None
+		if columns is None and _current_transaction.get() is None:
+			identities = _identity_map.get()
+			if identities is not None:
+				obj = identities.get((cls, pk))
+				if obj is not None:
+					return obj
+		sql = cls.__find__ if columns is None else _find_sql(cls, _columns(columns))
+		rs = await select(sql, [pk], 1)
 		if len(rs) == 0:
 			return None
-		return cls(**rs[0])
+		obj = cls(**rs[0])
+		if identities is not None:
+			identities[(cls, pk)] = obj
+		return obj
+
+	async def load(self, *fields):
+		'''
+		读取没有加载的字段，例如findAll缺省不查询的deferred字段
+		:param fields:要读取的字段，缺省为所有没有加载的字段
+		:return:self
+		'''
+		fields = tuple(f for f in (fields or self.__fields__) if f not in self)
+		if not fields:
+			return self
+		rs = await select(_find_sql(self.__class__, fields), [self.getValue(self.__primary_key__)], 1)
+		if rs:
+			dict.update(self, rs[0])
+		return self
 
 	async def save(self):
 		args = list(map(self.getValueOrDefault, self.__fields__))
 		args.append(self.getValueOrDefault(self.__primary_key__))
 		rows = await execute(self.__insert__, args)
 		if rows != 1:
-			logging.warn('failed to insert record: affected rows: %s' % rows)
+			logger.warning('failed to insert record: affected rows: %s', rows)
+		self._adjustCount(rows)
+
+	@classmethod
+	async def saveMany(cls, objs, chunk=None):
+		'''
+		批量插入记录，每chunk条记录生成一条多行INSERT，所有语句在同一个事务中执行
+		:param objs:记录对象集合
+		:param chunk:每条语句的最大记录数，缺省使用_batch_size
+		:return:插入的行数
+		'''
+		objs = list(objs)
+		chunk = chunk or _batch_size
+		statements = []
+		for i in range(0, len(objs), chunk):
+			part = objs[i:i + chunk]
+			args = []
+			for obj in part:
+				args.extend(map(obj.getValueOrDefault, cls.__fields__))
+				args.append(obj.getValueOrDefault(cls.__primary_key__))
+			statements.append((cls.__insert_head__ + ','.join([cls.__insert_row__] * len(part)), args))
+		if not statements:
+			return 0
+		rows = sum(await execute_batch(statements))
+		if rows != len(objs):
+			logger.warning('failed to insert records: affected rows: %s, records: %s', rows, len(objs))
+		cls._adjustCount(rows)
+		return rows
+
+	@classmethod
+	async def updateMany(cls, objs, chunk=None):
+		'''
+		批量按主键更新记录，每chunk条记录生成一条UPDATE ... SET `f` = CASE `pk` WHEN ? THEN ? ... END，
+		所有语句在同一个事务中执行
+		:param objs:记录对象集合
+		:param chunk:每条语句的最大记录数，缺省使用_batch_size
+		:return:更新的行数(MySQL只统计值发生变化的行)
+		'''
+		objs = list(objs)
+		chunk = chunk or _batch_size
+		pk = cls.__primary_key__
+		statements = []
+		for i in range(0, len(objs), chunk):
+			part = objs[i:i + chunk]
+			keys = [obj.getValue(pk) for obj in part]
+			whens = ' '.join(['WHEN ? THEN ?'] * len(part))
+			sets = []
+			args = []
+			# 只更新这一批记录都已经加载的字段
+			fields = [f for f in cls.__fields__ if all(f in obj for obj in part)]
+			if not fields:
+				continue
+			for f in fields:
+				sets.append('`%s` = CASE `%s` %s END' % (cls.__mappings__[f].name or f, pk, whens))
+				for key, obj in zip(keys, part):
+					args.append(key)
+					args.append(obj.getValue(f))
+			args.extend(keys)
+			sql = 'UPDATE `%s` SET %s WHERE `%s` IN (%s)' % (cls.__table__, ', '.join(sets), pk, create_args_string(len(part)))
+			statements.append((sql, args))
+		if not statements:
+			return 0
+		return sum(await execute_batch(statements))
 
 	async def update(self):
-		args = list(map(self.getValue, self.__fields__))
+		fields = self.__fields__
+		sql = self.__update__
+		if not all(f in self for f in fields):
+			# 只加载了部分字段，没有加载的字段保持数据库中的值
+			fields = tuple(f for f in fields if f in self)
+			if not fields:
+				logger.warning('nothing to update: no field of %s is loaded', self.__class__.__name__)
+				return
+			sql = _update_sql(self.__class__, fields)
+		args = list(map(self.getValue, fields))
 		args.append(self.getValue(self.__primary_key__))
-		rows = await execute(self.__update__, args)
+		rows = await execute(sql, args)
 		if rows != 1:
-			logging.warn('failed to update by primary key: affected rows: %s' % rows)
+			logger.warning('failed to update by primary key: affected rows: %s', rows)
 
 	async def remove(self):
 		args = [self.getValue(self.__primary_key__)]
 		rows = await execute(self.__delete__, args)
 		if rows != 1:
-			logging.warn('failed to remove by primary key: affected rows: %s' % rows)
\ No newline at end of file
+			logger.warning('failed to remove by primary key: affected rows: %s', rows)
+		self._adjustCount(-rows)
\ No newline at end of file
@@ -0,0 +1,87 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+JSON序列化
+dumps(obj)返回UTF-8编码的bytes。安装了orjson时缺省使用orjson，否则使用标准库json。
+Model是dict的子类，两种后端都直接按dict序列化(字段顺序与查询的列顺序一致)，不经过Python层的回调；
+其他类型(例如apis.Page、orm.Row)通过register注册的函数转换成可以序列化的对象。
+'''
+
+import json, logging
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+from apis import Page
+from orm import Row
+
+logger = logging.getLogger('serializer')
+
+# 类型 => 转换函数
+_encoders = {}
+# 类型 => 转换函数，按MRO查找的结果
+_resolved = {}
+
+def register(cls, fn):
+	'''
+	注册类型的转换函数，cls及其子类的对象序列化时先调用fn(obj)
+	:cls:类型
+	:fn:转换函数，返回可以序列化的对象
+	:return:无
+	'''
+	_encoders[cls] = fn
+	_resolved.clear()
+
+def _default(o):
+	t = type(o)
+	fn = _resolved.get(t)
+	if fn is None:
+		fn = next((_encoders[c] for c in t.__mro__ if c in _encoders), None)
+		if fn is None:
+			# 与原来的default=lambda o: o.__dict__保持一致
+			fn = _object_dict
+		_resolved[t] = fn
+	return fn(o)
+
+def _object_dict(o):
+	return o.__dict__
+
+def _json_dumps(obj):
+	return json.dumps(obj, ensure_ascii=False, default=_default).encode('utf-8')
+
+def _orjson_dumps(obj):
+	try:
+		return orjson.dumps(obj, default=_default)
+	except TypeError:
+		# orjson不支持的数据(非字符串的key、超过64位的整数等)交给标准库
+		return _json_dumps(obj)
+
+_backends = {
+	'json': _json_dumps,
+	'orjson': _orjson_dumps
+}
+
+dumps = _orjson_dumps if orjson is not None else _json_dumps
+
+def set_backend(name):
+	'''
+	选择序列化后端
+	:name:'auto'、'orjson'或者'json'
+	:return:无
+	'''
+	global dumps
+	if name == 'auto':
+		name = 'orjson' if orjson is not None else 'json'
+	if name == 'orjson' and orjson is None:
+		raise ValueError('orjson is not installed.')
+	if name not in _backends:
+		raise ValueError('Invalid json backend: %s' % name)
+	dumps = _backends[name]
+	logger.info('json backend: %s', name)
+
+register(Page, _object_dict)
+register(Row, Row.toDict)
@@ -0,0 +1,64 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+模板渲染方式
+sync - 在事件循环中直接渲染，渲染期间其他请求全部等待
+async - jinja2的enable_async/render_async，只在模板中的异步调用处让出事件循环，纯CPU的渲染仍然阻塞
+thread - 在有界线程池中渲染，事件循环在渲染期间可以继续处理其他请求(受GIL影响，渲染本身不会更快)
+'''
+
+import asyncio, functools, logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('templating')
+
+RENDER_MODES = ('sync', 'async', 'thread')
+
+class Renderer(object):
+	'''
+	按配置的方式渲染模板
+	:env:jinja2 Environment，async方式要求创建时指定enable_async=True
+	:mode:渲染方式，sync、async或者thread
+	:workers:thread方式的线程数
+	'''
+	def __init__(self, env, mode='sync', workers=4):
+		if mode not in RENDER_MODES:
+			raise ValueError('invalid render mode: %s' % mode)
+		if mode == 'async' and not env.is_async:
+			raise ValueError('render mode async requires Environment(enable_async=True)')
+		self.env = env
+		self.mode = mode
+		self.workers = workers
+		self._executor = None
+		logger.info('template render mode: %s', mode)
+
+	def _get_executor(self):
+		if self._executor is None:
+			self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='jinja2')
+		return self._executor
+
+	async def render(self, name, context):
+		'''
+		渲染模板
+		:name:模板名
+		:context:模板参数
+		:return:渲染结果字符串
+		'''
+		template = self.env.get_template(name)
+		if self.mode == 'async':
+			return await template.render_async(**context)
+		if self.mode == 'thread':
+			loop = asyncio.get_event_loop()
+			return await loop.run_in_executor(self._get_executor(), functools.partial(template.render, **context))
+		return template.render(**context)
+
+	def shutdown(self):
+		'''
+		关闭渲染线程池
+		:return:无
+		'''
+		if self._executor is not None:
+			self._executor.shutdown(wait=False)
+			self._executor = None
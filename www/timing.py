@@ -0,0 +1,98 @@
+# -*- coding:utf-8 -*-
+
+__author__ = "Sunshine'Z"
+
+'''
+请求耗时统计
+timing_factory中间件为每个请求创建一个Timer，保存在contextvar中；
+各阶段(auth、handler、render)用with timing.phase(name)累计耗时，orm的每条语句累计到db阶段并记录语句。
+不在请求中(例如脚本、后台任务)时所有函数都不做任何事情。
+'''
+
+import contextvars, time
+
+# 每个请求最多记录的语句数，超过的语句只累计耗时
+MAX_QUERIES = 50
+
+_current = contextvars.ContextVar('request_timer', default=None)
+
+class Timer(object):
+	'''
+	一个请求的耗时记录
+	:start:开始时间(time.perf_counter())
+	:phases:阶段名 => 累计耗时(秒)，按第一次出现的顺序
+	:queries:[(sql语句, 耗时(秒)), ...]
+	:query_count:执行的语句总数
+	'''
+	def __init__(self):
+		self.start = time.perf_counter()
+		self.phases = {}
+		self.queries = []
+		self.query_count = 0
+
+	def add(self, name, seconds):
+		self.phases[name] = self.phases.get(name, 0) + seconds
+
+	def elapsed(self):
+		return time.perf_counter() - self.start
+
+	def server_timing(self, total=None):
+		'''
+		生成Server-Timing响应头，单位为毫秒
+		:total:总耗时(秒)，缺省为到目前为止的耗时
+		:return:字符串，例如 total;dur=12.5, auth;dur=0.4, db;dur=8.1
+		'''
+		if total is None:
+			total = self.elapsed()
+		items = ['total;dur=%.1f' % (total * 1000)]
+		for name, seconds in self.phases.items():
+			items.append('%s;dur=%.1f' % (name, seconds * 1000))
+		return ', '.join(items)
+
+def start():
+	'''
+	为当前任务创建Timer
+	:return:(Timer, token)，结束时调用stop(token)
+	'''
+	timer = Timer()
+	return timer, _current.set(timer)
+
+def stop(token):
+	_current.reset(token)
+
+class phase(object):
+	'''
+	with timing.phase('render'):
+		...
+	将块内的耗时累计到当前请求的指定阶段
+	'''
+	__slots__ = ('name', 'timer', 'begin')
+
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		self.timer = _current.get()
+		if self.timer is not None:
+			self.begin = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		if self.timer is not None:
+			self.timer.add(self.name, time.perf_counter() - self.begin)
+		return False
+
+def record_query(sql, seconds):
+	'''
+	记录一条语句的耗时，由orm在每条语句执行后调用
+	:sql:sql语句
+	:seconds:耗时(秒)
+	:return:无
+	'''
+	timer = _current.get()
+	if timer is None:
+		return
+	timer.add('db', seconds)
+	timer.query_count += 1
+	if len(timer.queries) < MAX_QUERIES:
+		timer.queries.append((sql, seconds))